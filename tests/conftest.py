@@ -3,15 +3,27 @@ from __future__ import annotations
 import multiprocessing
 import os
 from pathlib import Path
+from typing import Dict
 from typing import Iterable
+from typing import List
 from typing import Type
 from unittest import mock
 from unittest.mock import MagicMock
 
 import pytest
 import tomli
+from hypothesis import settings
 
 from zabbix_auto_config import models
+from zabbix_auto_config import utils
+from zabbix_auto_config.state import Manager
+from zabbix_auto_config.state import get_manager
+
+# Regular runs use a small, reproducible set of examples. The nightly CI run
+# loads the "nightly" profile to search more of the input space.
+settings.register_profile("dev", max_examples=100, derandomize=True)
+settings.register_profile("nightly", max_examples=1000)
+settings.load_profile(os.getenv("HYPOTHESIS_PROFILE", "dev"))
 
 
 @pytest.fixture(scope="function")
@@ -114,8 +126,8 @@ def config(sample_config: str) -> Iterable[models.Settings]:
     yield models.Settings(**tomli.loads(sample_config))
 
 
-@pytest.fixture
-def hostgroup_map_file(tmp_path: Path) -> Iterable[Path]:
+@pytest.fixture(scope="session")
+def hostgroup_map_file(tmp_path_factory: pytest.TempPathFactory) -> Iterable[Path]:
     contents = """
 # This file defines assosiation between siteadm fetched from Nivlheim and hostsgroups in Zabbix.
 # A siteadm can be assosiated only with one hostgroup or usergroup.
@@ -133,19 +145,37 @@ user2@example.com:Hostgroup-user2-secondary
 #
 user3@example.com:Hostgroup-user3-primary
 """
-    map_file_path = tmp_path / "siteadmin_hostgroup_map.txt"
+    map_file_path = tmp_path_factory.mktemp("maps") / "siteadmin_hostgroup_map.txt"
     map_file_path.write_text(contents)
     yield map_file_path
 
 
+@pytest.fixture(scope="session")
+def hostgroup_map(hostgroup_map_file: Path) -> Iterable[Dict[str, List[str]]]:
+    """The parsed contents of `hostgroup_map_file`.
+
+    Shared between tests, so tests must not modify it."""
+    yield utils.read_map_file(hostgroup_map_file)
+
+
 @pytest.fixture(autouse=True, scope="session")
 def setup_multiprocessing_start_method() -> None:
     # On MacOS we have to set the start mode to fork
-    # when using multiprocessing-logging
+    # for child processes to inherit the logging queue handler
     if os.uname == "Darwin":
         multiprocessing.set_start_method("fork", force=True)
 
 
+@pytest.fixture(scope="session")
+def state_manager() -> Iterable[Manager]:
+    """State manager shared by all tests in the session.
+
+    Each manager runs in its own server process, so we start it only once."""
+    manager = get_manager()
+    yield manager
+    manager.shutdown()
+
+
 class PicklableMock(MagicMock):
     def __reduce__(self):
         return (MagicMock, ())
@@ -24,5 +24,5 @@ def collect(*args: Any, **kwargs: Any) -> List[Host]:
         source = kwargs.get("source")
         if source:
             host["properties"].append(source)
-        hosts.append(Host(**host))
+        hosts.append(Host.model_validate(host))
     return hosts
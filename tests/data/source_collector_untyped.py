@@ -21,5 +21,5 @@ def collect(*args, **kwargs):
         source = kwargs.get("source")
         if source:
             host["properties"].append(source)
-        hosts.append(zabbix_auto_config.models.Host(**host))
+        hosts.append(zabbix_auto_config.models.Host.model_validate(host))
     return hosts
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import json
+import multiprocessing
+from pathlib import Path
+
+import pytest
+
+import zabbix_auto_config
+from zabbix_auto_config import write_health
+from zabbix_auto_config.processing import BaseProcess
+from zabbix_auto_config.state import State
+
+
+def test_write_health(tmp_path: Path):
+    health_file = tmp_path / "health.json"
+    processes = [BaseProcess("foo", State()), BaseProcess("bar", State())]
+    processes[1].state.set_error(Exception("Test error"))
+    queue = multiprocessing.Queue()
+
+    write_health(health_file, processes, [queue], failsafe=20)
+
+    health = json.loads(health_file.read_text())
+    assert health["all_ok"] is False
+    assert health["failsafe"] == 20
+    assert [p["name"] for p in health["processes"]] == ["foo", "bar"]
+    assert health["processes"][0]["ok"] is True
+    assert health["processes"][0]["alive"] is False  # never started
+    assert health["processes"][1]["ok"] is False
+    assert health["processes"][1]["error"] == "Test error"
+    assert health["queues"] == [{"size": 0}]
+    # The temporary file is moved into place
+    assert list(tmp_path.iterdir()) == [health_file]
+
+
+def test_write_health_without_orjson(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(zabbix_auto_config, "orjson", None)
+    health_file = tmp_path / "health.json"
+
+    write_health(health_file, [BaseProcess("foo", State())], [], failsafe=20)
+
+    health = json.loads(health_file.read_text())
+    assert health["all_ok"] is True
+    assert health["processes"][0]["name"] == "foo"
+
+
+def test_write_health_removes_tmp_file_on_error(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture
+):
+    def replace(src: str, dst: str) -> None:
+        raise OSError("Test error")
+
+    monkeypatch.setattr(zabbix_auto_config.os, "replace", replace)
+    health_file = tmp_path / "health.json"
+
+    write_health(health_file, [BaseProcess("foo", State())], [], failsafe=20)
+
+    assert "Unable to write health file" in caplog.text
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_process_to_health_dict():
+    process = BaseProcess("foo", State())
+    health = process.to_health_dict()
+    assert health == {
+        "name": "foo",
+        "pid": None,
+        "alive": False,
+        **process.state.asdict(),
+    }
+    # Process info comes before the state
+    assert list(health)[:3] == ["name", "pid", "alive"]
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import logging
+import logging.handlers
+import multiprocessing
+from typing import List
+
+from zabbix_auto_config import setup_logging_queue
+from zabbix_auto_config.processing import BaseProcess
+from zabbix_auto_config.state import State
+
+
+class ListHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records: List[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+def log_from_child() -> None:
+    logging.getLogger().warning("Hello from %s", "child")
+
+
+def test_setup_logging_queue() -> None:
+    root = logging.getLogger()
+    old_handlers = root.handlers[:]
+    handler = ListHandler()
+    root.handlers = [handler]
+    try:
+        listener = setup_logging_queue()
+        assert len(root.handlers) == 1
+        assert isinstance(root.handlers[0], logging.handlers.QueueHandler)
+
+        process = multiprocessing.get_context("fork").Process(target=log_from_child)
+        process.start()
+        process.join()
+        root.warning("Hello from parent")
+        listener.stop()
+    finally:
+        root.handlers = old_handlers
+
+    messages = sorted(record.getMessage() for record in handler.records)
+    assert messages == ["Hello from child", "Hello from parent"]
+
+
+class LoggingProcess(BaseProcess):
+    def work(self) -> None:
+        logging.getLogger().info("Hello from %s", self.name)
+        self.stop_event.set()
+
+
+def test_process_logs_to_queue_with_spawn() -> None:
+    """Spawned processes do not inherit handlers, so they must set up the queue handler."""
+    old_start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method("spawn", force=True)
+    root = logging.getLogger()
+    old_handlers = root.handlers[:]
+    old_level = root.level
+    handler = ListHandler()
+    root.handlers = [handler]
+    root.setLevel(logging.INFO)
+    try:
+        listener = setup_logging_queue()
+        process = LoggingProcess("spawned", State(), log_queue=listener.queue)
+        process.start()
+        process.join(timeout=30)
+        listener.stop()
+    finally:
+        root.handlers = old_handlers
+        root.setLevel(old_level)
+        multiprocessing.set_start_method(old_start_method, force=True)
+
+    assert process.exitcode == 0
+    messages = [record.getMessage() for record in handler.records]
+    assert "Hello from spawned" in messages
@@ -111,6 +111,83 @@ def test_host_merge(full_hosts):
     assert h1.inventory == {"foo": "bar", "baz": "qux"}
 
 
+def test_host_merge_interfaces():
+    """Tests that Host.merge() adds missing interface types in type order"""
+    h1 = models.Host(
+        hostname="foo.example.com",
+        enabled=True,
+        interfaces=[models.Interface(endpoint="foo", port="161", type=3)],
+    )
+    h2 = models.Host(
+        hostname="foo.example.com",
+        enabled=True,
+        interfaces=[
+            models.Interface(endpoint="bar", port="10050", type=1),
+            models.Interface(endpoint="bar", port="161", type=3),
+        ],
+    )
+
+    h1.merge(h2)
+
+    assert [(i.type, i.endpoint) for i in h1.interfaces] == [(1, "bar"), (3, "foo")]
+
+
+def test_host_merge_inventory_conflict(caplog: pytest.LogCaptureFixture):
+    """Tests that Host.merge() keeps the existing value of conflicting inventory"""
+    h1 = models.Host(
+        hostname="foo.example.com",
+        enabled=True,
+        inventory={"location": "x", "type": "server"},
+    )
+    h2 = models.Host(
+        hostname="foo.example.com",
+        enabled=True,
+        inventory={"location": "y", "type": "server", "vendor": "acme"},
+    )
+
+    h1.merge(h2)
+
+    assert h1.inventory == {"location": "x", "type": "server", "vendor": "acme"}
+    assert len(caplog.records) == 1
+    assert "'location'" in caplog.records[0].message
+
+
+def test_host_interns_strings():
+    """Equal set members of different hosts are the same object"""
+    # Build the strings at runtime so they are not interned as constants
+    h1 = models.Host(
+        hostname="foo.example.com",
+        enabled=True,
+        sources=["".join(["source", "1"])],
+        tags=[["".join(["tag", "1"]), "x"]],
+    )
+    h2 = models.Host(
+        hostname="bar.example.com",
+        enabled=True,
+        sources=["".join(["sour", "ce1"])],
+        tags=[["".join(["ta", "g1"]), "x"]],
+    )
+    assert next(iter(h1.sources)) is next(iter(h2.sources))
+    assert next(iter(h1.tags))[0] is next(iter(h2.tags))[0]
+
+
+def test_host_merge_sorts_interfaces():
+    """Tests that Host.merge() sorts interfaces even if none are added"""
+    h1 = models.Host(
+        hostname="foo.example.com",
+        enabled=True,
+        interfaces=[
+            models.Interface(endpoint="foo", port="161", type=3),
+            models.Interface(endpoint="foo", port="10050", type=1),
+        ],
+    )
+    h2 = models.Host(hostname="foo.example.com", enabled=True)
+
+    h1.merge(h2)
+
+    assert [i.type for i in h1.interfaces] == [1, 3]
+
+
 def test_host_merge_invalid(full_hosts):
     """Tests Host.merge() with incorrect argument type"""
     host = find_host_by_hostname(full_hosts, "foo")
@@ -119,6 +196,27 @@ def test_host_merge_invalid(full_hosts):
         h1.merge(object())
 
 
+def test_host_copy_for_modifier(full_hosts):
+    """Tests that changes to a Host.copy_for_modifier() copy leave the original intact"""
+    host = models.Host(**find_host_by_hostname(full_hosts, "foo"))
+    original = host.model_copy(deep=True)
+
+    copy = host.copy_for_modifier()
+    assert copy == host
+    copy.properties.add("newprop")
+    copy.siteadmins.add("eve@example.com")
+    copy.sources.add("newsource")
+    copy.tags.add(("newtag", "x"))
+    copy.inventory["newkey"] = "value"
+    for interface in copy.interfaces:
+        interface.port = "12345"
+        if interface.details:
+            interface.details["community"] = "changed"
+    copy.interfaces.append(models.Interface(endpoint="new", port="1", type=99))
+
+    assert host == original
+
+
 @pytest.mark.parametrize(
     "level,expect",
     [
@@ -210,3 +308,14 @@ def test_zabbix_settings_timeout(timeout: int, expect: Optional[int]) -> None:
         timeout=timeout,
     )
     assert settings.timeout == expect
+
+
+@pytest.mark.parametrize("size", [0, -1])
+def test_zacsettings_source_queue_size_invalid(size: int) -> None:
+    with pytest.raises(ValidationError):
+        models.ZacSettings(
+            db_uri="",
+            source_collector_dir="",
+            host_modifier_dir="",
+            source_queue_size=size,
+        )
@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+from unittest.mock import MagicMock
+
+import psycopg2
+import pytest
+
+from zabbix_auto_config.processing import create_indexes
+
+
+def test_create_indexes(mock_psycopg2_connect: MagicMock) -> None:
+    create_indexes("postgresql://localhost/zac")
+
+    connection = mock_psycopg2_connect.return_value
+    cursor = connection.cursor.return_value.__enter__.return_value
+    statements = [call.args[0] for call in cursor.execute.call_args_list]
+    assert len(statements) == 3
+    assert all(s.startswith("CREATE INDEX IF NOT EXISTS") for s in statements)
+    connection.close.assert_called_once()
+
+
+def test_create_indexes_connection_error(
+    mock_psycopg2_connect: MagicMock, caplog: pytest.LogCaptureFixture
+) -> None:
+    mock_psycopg2_connect.side_effect = psycopg2.OperationalError("Test error")
+
+    create_indexes("postgresql://localhost/zac")
+
+    assert "Unable to connect to database to create indexes" in caplog.text
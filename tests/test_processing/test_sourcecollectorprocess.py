@@ -9,7 +9,7 @@ import pytest
 from zabbix_auto_config.models import Host
 from zabbix_auto_config.models import SourceCollectorSettings
 from zabbix_auto_config.processing import SourceCollectorProcess
-from zabbix_auto_config.state import get_manager
+from zabbix_auto_config.state import Manager
 
 
 class SourceCollector:
@@ -23,10 +23,10 @@ class SourceCollector:
 
 
 @pytest.mark.timeout(5)
-def test_source_collector_process():
+def test_source_collector_process(state_manager: Manager):
     process = SourceCollectorProcess(
         name="test-source",
-        state=get_manager().State(),
+        state=state_manager.State(),
         module=SourceCollector,
         config=SourceCollectorSettings(
             module_name="source_collector",
@@ -37,11 +37,13 @@ def test_source_collector_process():
             error_tolerance=5,
         ),
         source_hosts_queue=multiprocessing.Queue(),
+        source_hosts_ready=multiprocessing.Event(),
     )
 
     try:
         process.start()
         hosts = process.source_hosts_queue.get()
+        assert process.source_hosts_ready.wait(timeout=1) is True
         assert len(hosts["hosts"]) == 2
         assert hosts["hosts"][0].hostname == "foo.example.com"
         assert process.state.ok is True
@@ -58,10 +60,10 @@ class FaultySourceCollector:
 
 
 @pytest.mark.timeout(5)
-def test_source_collector_disable_on_failure():
+def test_source_collector_disable_on_failure(state_manager: Manager):
     process = SourceCollectorProcess(
         name="test-source",
-        state=get_manager().State(),
+        state=state_manager.State(),
         module=FaultySourceCollector,
         config=SourceCollectorSettings(
             module_name="faulty_source_collector",
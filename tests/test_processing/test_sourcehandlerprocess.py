@@ -0,0 +1,35 @@
+from __future__ import annotations
+
+import multiprocessing
+from unittest.mock import MagicMock
+from unittest.mock import patch
+
+import pytest
+
+from zabbix_auto_config.processing import SourceHandlerProcess
+from zabbix_auto_config.state import State
+
+
+def test_get_current_source_hosts_skips_rows_without_hostname(
+    caplog: pytest.LogCaptureFixture,
+) -> None:
+    with patch("psycopg2.connect"):
+        process = SourceHandlerProcess(
+            "source-handler", State(), "", [], multiprocessing.Event()
+        )
+
+    host = {"hostname": "foo.example.com", "enabled": True}
+    cursor = MagicMock()
+    cursor.__iter__.return_value = iter(
+        [
+            (host,),
+            ({"enabled": True},),  # no hostname
+            ({"hostname": 123},),  # hostname not a string
+            (["not", "a", "dict"],),
+        ]
+    )
+
+    hosts = process.get_current_source_hosts(cursor, "source1")
+
+    assert hosts == {"foo.example.com": host}
+    assert caplog.text.count("no hostname") == 3
@@ -2,16 +2,21 @@ from __future__ import annotations
 
 import time
 from pathlib import Path
+from typing import Dict
+from typing import List
 from unittest.mock import patch
 
 import pytest
+import pyzabbix
 import requests
 
 from zabbix_auto_config import exceptions
 from zabbix_auto_config.models import Settings
 from zabbix_auto_config.models import ZabbixSettings
+from zabbix_auto_config.processing import ZabbixHostgroupUpdater
 from zabbix_auto_config.processing import ZabbixUpdater
-from zabbix_auto_config.state import get_manager
+from zabbix_auto_config.state import Manager
+from zabbix_auto_config.state import State
 
 from ..conftest import MockZabbixAPI
 from ..conftest import PicklableMock
@@ -45,7 +50,8 @@ def test_zabbixupdater_connect_timeout(mock_psycopg2_connect, config: Settings):
         ZabbixUpdater(
             name="connect-timeout",
             db_uri="",
-            state=get_manager().State(),
+            # The process is never started, so no manager proxy is needed
+            state=State(),
             settings=config,
         )
     assert "connect timeout" in exc_info.exconly()
@@ -58,7 +64,7 @@ class TimeoutUpdater(ZabbixUpdater):
 
 @pytest.mark.timeout(5)
 def test_zabbixupdater_read_timeout(
-    tmp_path: Path, mock_psycopg2_connect, config: Settings
+    state_manager: Manager, tmp_path: Path, mock_psycopg2_connect, config: Settings
 ):
     # TODO: use mapping file fixtures from #67
     map_dir = tmp_path / "maps"
@@ -78,7 +84,7 @@ def test_zabbixupdater_read_timeout(
     process = TimeoutUpdater(
         name="read-timeout",
         db_uri="",
-        state=get_manager().State(),
+        state=state_manager.State(),
         settings=config,
     )
 
@@ -93,3 +99,41 @@ def test_zabbixupdater_read_timeout(
         process.stop_event.set()
     finally:
         process.join(timeout=0.01)
+
+
+def test_mass_update_hosts_retries_per_host(
+    tmp_path: Path,
+    mock_psycopg2_connect,
+    config: Settings,
+    caplog: pytest.LogCaptureFixture,
+):
+    map_dir = tmp_path / "maps"
+    map_dir.mkdir()
+    (map_dir / "property_template_map.txt").touch()
+    (map_dir / "property_hostgroup_map.txt").touch()
+    (map_dir / "siteadmin_hostgroup_map.txt").touch()
+    config.zabbix = ZabbixSettings(
+        map_dir=str(map_dir), url="", username="", password="", dryrun=False
+    )
+    process = ZabbixHostgroupUpdater(
+        name="hostgroup-updater", db_uri="", state=State(), settings=config
+    )
+
+    updated: List[str] = []
+
+    def update(hosts: List[Dict[str, str]]) -> None:
+        if any(host["host"] == "bad.example.com" for host in hosts):
+            raise pyzabbix.ZabbixAPIException("Invalid host")
+        updated.extend(host["host"] for host in hosts)
+
+    hosts = [
+        {"host": "foo.example.com", "hostid": "1"},
+        {"host": "bad.example.com", "hostid": "2"},
+        {"host": "bar.example.com", "hostid": "3"},
+    ]
+    process.mass_update_hosts(update, hosts, "adding hostgroup 'foo'")
+
+    assert updated == ["foo.example.com", "bar.example.com"]
+    errors = [r for r in caplog.records if r.levelname == "ERROR"]
+    assert len(errors) == 1
+    assert "'bad.example.com' (2)" in errors[0].message
@@ -7,6 +7,7 @@ import pytest
 
 from zabbix_auto_config.exceptions import ZACException
 from zabbix_auto_config.processing import BaseProcess
+from zabbix_auto_config.state import Manager
 from zabbix_auto_config.state import State
 from zabbix_auto_config.state import StateProxy
 from zabbix_auto_config.state import get_manager
@@ -26,9 +27,9 @@ def test_manager_state():
 
 @pytest.mark.parametrize("use_manager", [True, False])
 @pytest.mark.parametrize("with_error", [True, False])
-def test_state_set_ok(use_manager: bool, with_error: bool):
+def test_state_set_ok(state_manager: Manager, use_manager: bool, with_error: bool):
     if use_manager:
-        state = get_manager().State()
+        state = state_manager.State()
     else:
         state = State()
 
@@ -58,9 +59,9 @@ class TimeoutError(Exception):
 
 
 @pytest.mark.parametrize("use_manager", [True, False])
-def test_state_set_error(use_manager: bool):
+def test_state_set_error(state_manager: Manager, use_manager: bool):
     if use_manager:
-        state = get_manager().State()
+        state = state_manager.State()
     else:
         state = State()
 
@@ -93,8 +94,8 @@ class ZACExceptionProcess(BaseProcess):
 
 
 @pytest.mark.timeout(10)
-def test_state_in_other_process() -> None:
-    state = get_manager().State()
+def test_state_in_other_process(state_manager: Manager) -> None:
+    state = state_manager.State()
     process = ZACExceptionProcess(
         name="test",
         state=state,
@@ -116,7 +117,7 @@ def test_state_in_other_process() -> None:
 
     # Test that multiple state proxies do not refer to the same
     # underlying State object
-    state2 = get_manager().State()
+    state2 = state_manager.State()
     assert state2.ok is True
     assert state2 is not state
     # This process will not fail and thus will set its state to OK
@@ -138,9 +139,9 @@ def test_state_in_other_process() -> None:
 
 
 @pytest.mark.parametrize("use_manager", [True, False])
-def test_state_asdict_ok(use_manager: bool) -> None:
+def test_state_asdict_ok(state_manager: Manager, use_manager: bool) -> None:
     if use_manager:
-        state = get_manager().State()
+        state = state_manager.State()
     else:
         state = State()
     state.set_ok()
@@ -158,9 +159,9 @@ class CustomException(Exception):
 
 
 @pytest.mark.parametrize("use_manager", [True, False])
-def test_state_asdict_error(use_manager: bool) -> None:
+def test_state_asdict_error(state_manager: Manager, use_manager: bool) -> None:
     if use_manager:
-        state = get_manager().State()
+        state = state_manager.State()
     else:
         state = State()
 
@@ -1,28 +1,26 @@
 from __future__ import annotations
 
+import datetime
 import logging
-from ipaddress import IPv4Address
-from ipaddress import IPv6Address
+import queue
+import sys
 from pathlib import Path
 from typing import Dict
 from typing import List
+from typing import Optional
 from typing import Set
 from typing import Tuple
-from typing import Union
 
 import pytest
-from hypothesis import HealthCheck
 from hypothesis import given
-from hypothesis import settings
 from hypothesis import strategies as st
 from pytest import LogCaptureFixture
 
 from zabbix_auto_config import utils
 
 
-@pytest.mark.parametrize(
-    "input,expected",
-    [
+def test_is_valid_regexp():
+    cases = [
         (r"\d", True),
         (r"\D", True),
         (r"\z", False),
@@ -30,15 +28,53 @@ from zabbix_auto_config import utils
         (r"\.", True),
         (r"\(", True),
         (r"\)", True),
-    ],
-)
-def test_is_valid_regexp(input: str, expected: bool):
-    assert utils.is_valid_regexp(input) == expected
+    ]
+    for pattern, expected in cases:
+        assert utils.is_valid_regexp(pattern) == expected, pattern
+
 
+def test_has_callable() -> None:
+    class Module:
+        collect = staticmethod(lambda: [])
+        modify = None
 
-@given(st.ip_addresses())
-def test_is_valid_ip(ip_address: Union[IPv4Address, IPv6Address]):
-    assert utils.is_valid_ip(str(ip_address))
+    assert utils.has_callable(Module, "collect")
+    assert not utils.has_callable(Module, "modify")
+    assert not utils.has_callable(Module, "missing")
+
+
+def test_compile_pattern():
+    pattern = utils.compile_pattern(r"proxy-\d+")
+    assert pattern.match("proxy-1")
+    assert not pattern.match("other-proxy-1")
+    assert utils.compile_pattern(r"proxy-\d+") is pattern
+
+
+@pytest.mark.parametrize(
+    "ip_address,expected",
+    [
+        ("0.0.0.0", True),
+        ("127.0.0.1", True),
+        ("192.168.0.1", True),
+        ("255.255.255.255", True),
+        ("::", True),
+        ("::1", True),
+        ("fe80::1", True),
+        ("2001:db8::1", True),
+        ("::ffff:192.0.2.1", True),
+        ("01.2.3.4", False),
+        # ipaddress accepts IPv6 scope IDs from Python 3.9
+        ("fe80::1%eth0", sys.version_info >= (3, 9)),
+        ("fe80::1%", False),
+        ("256.0.0.1", False),
+        ("1.2.3", False),
+        ("2001:db8::1::2", False),
+        ("foo.example.com", False),
+        ("", False),
+    ],
+)
+def test_is_valid_ip(ip_address: str, expected: bool):
+    assert utils.is_valid_ip(ip_address) == expected
 
 
 def test_read_map_file(tmp_path: Path, caplog: pytest.LogCaptureFixture):
@@ -105,17 +141,9 @@ def test_read_map_file(tmp_path: Path, caplog: pytest.LogCaptureFixture):
 
 
 @given(st.text())
-@settings(
-    max_examples=1000,
-    suppress_health_check=[HealthCheck.function_scoped_fixture],
-)
-def test_read_map_file_fuzz(tmp_path: Path, text: str):
-    tmpfile = tmp_path / "map_fuzz.txt"
-    tmpfile.write_text(
-        text,
-        encoding="utf-8",
-    )
-    m = utils.read_map_file(tmpfile)
+def test_read_map_file_fuzz(text: str):
+    # Parse the lines directly, skipping the round trip through the filesystem
+    m = utils._parse_map_lines(text.split("\n"), "<fuzz>")
     for key in m:
         assert key  # no empty keys
         for value in m[key]:
@@ -123,8 +151,41 @@ def test_read_map_file_fuzz(tmp_path: Path, text: str):
 
 
 @pytest.mark.parametrize(
-    "tags,expected",
+    "max_items,expect_removed,expect_left",
+    [
+        (None, 5, 0),
+        (2, 2, 3),
+        (10, 5, 0),
+        (0, 0, 5),
+    ],
+)
+def test_drain_queue(
+    max_items: Optional[int], expect_removed: int, expect_left: int
+) -> None:
+    # queue.Queue has the same interface, without the feeder thread delay
+    q: queue.Queue[int] = queue.Queue()
+    for i in range(5):
+        q.put(i)
+    assert utils.drain_queue(q, max_items=max_items) == expect_removed  # type: ignore[arg-type]
+    assert q.qsize() == expect_left
+
+
+@pytest.mark.parametrize(
+    "td,expected",
     [
+        (datetime.timedelta(), "00:00:00"),
+        (datetime.timedelta(seconds=59, microseconds=999999), "00:00:59"),
+        (datetime.timedelta(hours=1, minutes=2, seconds=3), "01:02:03"),
+        (datetime.timedelta(days=1, hours=1), "25:00:00"),
+        (datetime.timedelta(seconds=-61), "-00:01:01"),
+    ],
+)
+def test_timedelta_to_str(td: datetime.timedelta, expected: str) -> None:
+    assert utils.timedelta_to_str(td) == expected
+
+
+def test_zabbix_tags2zac_tags():
+    cases: List[Tuple[List[Dict[str, str]], Set[Tuple[str, str]]]] = [
         (
             [{"tag": "tag1", "value": "x"}],
             {("tag1", "x")},
@@ -134,20 +195,22 @@ def test_read_map_file_fuzz(tmp_path: Path, text: str):
             {("tag1", "x"), ("tag2", "y")},
         ),
         (
+            # Extra keys are ignored
             [{"tag": "tag1", "value": "x", "foo": "tag2", "bar": "y"}],
-            {("tag1", "x", "tag2", "y")},
+            {("tag1", "x")},
         ),
-    ],
-)
-def test_zabbix_tags2zac_tags(
-    tags: List[Dict[str, str]], expected: Set[Tuple[str, str]]
-):
-    assert utils.zabbix_tags2zac_tags(tags) == expected
+        (
+            # Key order does not matter
+            [{"value": "x", "tag": "tag1"}],
+            {("tag1", "x")},
+        ),
+    ]
+    for tags, expected in cases:
+        assert utils.zabbix_tags2zac_tags(tags) == expected, tags
 
 
-@pytest.mark.parametrize(
-    "tags,expected",
-    [
+def test_zac_tags2zabbix_tags():
+    cases: List[Tuple[Set[Tuple[str, ...]], List[Dict[str, str]]]] = [
         (
             {("tag1", "x")},
             [{"tag": "tag1", "value": "x"}],
@@ -160,14 +223,11 @@ def test_zabbix_tags2zac_tags(
             {("tag1", "x", "tag2", "y")},
             [{"tag": "tag1", "value": "x"}],
         ),
-    ],
-)
-def test_zac_tags2zabbix_tags(
-    tags: Set[Tuple[str, str]], expected: List[Dict[str, str]]
-):
-    zabbix_tags = utils.zac_tags2zabbix_tags(tags)
-    for tag in expected:
-        assert tag in zabbix_tags
+    ]
+    for tags, expected in cases:
+        zabbix_tags = utils.zac_tags2zabbix_tags(tags)
+        for tag in expected:
+            assert tag in zabbix_tags, tags
 
 
 # Test with the two prefixes we use + no prefix
@@ -175,8 +235,8 @@ def test_zac_tags2zabbix_tags(
     "prefix",
     ["Templates-", "Siteadmin-"],
 )
-def test_mapping_values_with_prefix(hostgroup_map_file: Path, prefix: str):
-    m = utils.read_map_file(hostgroup_map_file)
+def test_mapping_values_with_prefix(hostgroup_map: Dict[str, List[str]], prefix: str):
+    m = hostgroup_map
 
     # Make sure we read the map file correctly
     assert len(m) == 3
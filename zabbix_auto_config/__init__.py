@@ -1,33 +1,40 @@
 from __future__ import annotations
 
+import atexit
 import datetime
 import importlib
 import importlib.metadata
 import json
 import logging
+import logging.handlers
 import multiprocessing
+import multiprocessing.connection
 import os
 import os.path
+import signal
 import sys
 import time
 from typing import List
 
-import multiprocessing_logging
-import tomli
-
 from zabbix_auto_config.state import get_manager
 
 from . import exceptions
 from . import models
 from . import processing
+from . import utils
 from .__about__ import __version__
 from ._types import SourceCollectorDict
-from ._types import SourceCollectorModule
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def get_source_collectors(config: models.Settings) -> List[SourceCollectorDict]:
     source_collector_dir = config.zac.source_collector_dir
-    sys.path.append(source_collector_dir)
+    if source_collector_dir not in sys.path:
+        sys.path.append(source_collector_dir)
 
     source_collectors = []  # type: List[SourceCollectorDict]
     for (
@@ -44,7 +51,7 @@ def get_source_collectors(config: models.Settings) -> List[SourceCollectorDict]:
             )
             continue
 
-        if not isinstance(module, SourceCollectorModule):
+        if not utils.has_callable(module, "collect"):
             logging.error(
                 "Source collector named '%s' is not a valid source collector module",
                 source_collector_config.module_name,
@@ -68,6 +75,10 @@ def get_config():
     with open(config_file) as f:
         content = f.read()
 
+    # Only needed once at startup, so don't pay for the import when the
+    # package is imported for other purposes
+    import tomli
+
     config = tomli.loads(content)
     config = models.Settings(**config)
 
@@ -84,55 +95,79 @@ def write_health(
         "pid": os.getpid(),
         "cwd": os.getcwd(),
         "all_ok": True,
-        "processes": [],
-        "queues": [],
+        "processes": [process.to_health_dict() for process in processes],
+        "queues": [{"size": queue.qsize()} for queue in queues],
         "failsafe": failsafe,
     }
 
-    for process in processes:
-        health["processes"].append(
-            {
-                "name": process.name,
-                "pid": process.pid,
-                "alive": process.is_alive(),
-                **process.state.asdict(),
-            }
-        )
-
-    health["all_ok"] = all(p.state.ok for p in processes)
-
-    for queue in queues:
-        health["queues"].append(
-            {
-                "size": queue.qsize(),
-            }
-        )
+    # Use the state we already fetched instead of asking each proxy again
+    health["all_ok"] = all(p["ok"] for p in health["processes"])
 
+    # Write to a temporary file and move it into place, so that readers
+    # never see a partially written health file
+    tmp_file = f"{health_file}.tmp"
     try:
-        with open(health_file, "w") as f:
-            f.write(json.dumps(health))
+        if orjson is not None:
+            with open(tmp_file, "wb") as f:
+                f.write(orjson.dumps(health))
+        else:
+            with open(tmp_file, "w") as f:
+                json.dump(health, f)
+        os.replace(tmp_file, health_file)
     except Exception as e:
         logging.error("Unable to write health file %s: %s", health_file, e)
+        # Don't leave a partially written file behind
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
 
 
 def log_process_status(processes):
     process_statuses = []
 
+    # Poll all the sentinels at once instead of calling is_alive() on each process
+    exited = set(
+        multiprocessing.connection.wait(
+            [process.sentinel for process in processes], timeout=0
+        )
+    )
     for process in processes:
         process_name = process.name
-        process_status = "alive" if process.is_alive() else "dead"
+        process_status = "dead" if process.sentinel in exited else "alive"
         process_statuses.append(f"{process_name} is {process_status}")
 
     logging.info("Process status: %s", ", ".join(process_statuses))
 
 
+def setup_logging_queue() -> logging.handlers.QueueListener:
+    """Route log records from all processes through a queue to the main process.
+
+    The root logger's handlers are moved to a listener thread in the main
+    process and replaced by a handler that puts records on the queue.
+    Processes started by ZAC install a handler for the listener's queue
+    themselves (see `BaseProcess.setup_logging`).
+    """
+    root = logging.getLogger()
+    log_queue = multiprocessing.Queue(-1)
+    listener = logging.handlers.QueueListener(
+        log_queue, *root.handlers, respect_handler_level=True
+    )
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    return listener
+
+
 def main():
-    multiprocessing_logging.install_mp_handler()
     logging.basicConfig(
         format="%(asctime)s %(levelname)s [%(processName)s %(process)d] [%(name)s] %(message)s",
         datefmt="%Y-%m-%dT%H:%M:%S%z",
         level=logging.DEBUG,
     )
+    listener = setup_logging_queue()
+    atexit.register(listener.stop)  # flush queued records on exit
     config = get_config()
     logging.getLogger().setLevel(config.zac.log_level)
     logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
@@ -142,16 +177,21 @@ def main():
     state_manager = get_manager()
     processes = []  # type: List[processing.BaseProcess]
 
+    processing.create_indexes(config.zac.db_uri)
+
     source_hosts_queues = []
+    source_hosts_ready = multiprocessing.Event()
     source_collectors = get_source_collectors(config)
     for source_collector in source_collectors:
-        source_hosts_queue = multiprocessing.Queue(maxsize=1)
+        source_hosts_queue = multiprocessing.Queue(maxsize=config.zac.source_queue_size)
         process = processing.SourceCollectorProcess(
             source_collector["name"],
             state_manager.State(),
             source_collector["module"],
             source_collector["config"],
             source_hosts_queue,
+            source_hosts_ready,
+            log_queue=listener.queue,
         )
         source_hosts_queues.append(source_hosts_queue)
         processes.append(process)
@@ -162,6 +202,8 @@ def main():
             state_manager.State(),
             config.zac.db_uri,
             source_hosts_queues,
+            source_hosts_ready,
+            log_queue=listener.queue,
         )
         processes.append(process)
 
@@ -170,6 +212,7 @@ def main():
             state_manager.State(),
             config.zac.db_uri,
             config.zac.host_modifier_dir,
+            log_queue=listener.queue,
         )
         processes.append(process)
 
@@ -178,6 +221,7 @@ def main():
             state_manager.State(),
             config.zac.db_uri,
             config,
+            log_queue=listener.queue,
         )
         processes.append(process)
 
@@ -186,6 +230,7 @@ def main():
             state_manager.State(),
             config.zac.db_uri,
             config,
+            log_queue=listener.queue,
         )
         processes.append(process)
 
@@ -194,6 +239,7 @@ def main():
             state_manager.State(),
             config.zac.db_uri,
             config,
+            log_queue=listener.queue,
         )
         processes.append(process)
     except exceptions.ZACException as e:
@@ -205,32 +251,48 @@ def main():
 
     with processing.SignalHandler(stop_event):
         status_interval = 60
-        next_status = datetime.datetime.now()
-
-        while not stop_event.is_set():
-            if next_status < datetime.datetime.now():
-                if config.zac.health_file is not None:
-                    write_health(
-                        config.zac.health_file,
-                        processes,
-                        source_hosts_queues,
-                        config.zabbix.failsafe,
-                    )
-                log_process_status(processes)
-                next_status = datetime.datetime.now() + datetime.timedelta(
-                    seconds=status_interval
-                )
+        next_status = time.monotonic()
+        # A process' sentinel becomes ready when the process exits
+        sentinels = {process.sentinel: process for process in processes}
+        # Signals are written to this pipe, so the wait below returns as soon
+        # as we are told to stop
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_write, False)
+        old_wakeup_fd = signal.set_wakeup_fd(wakeup_write)
 
-            dead_process_names = [
-                process.name for process in processes if not process.is_alive()
-            ]
-            if dead_process_names:
-                logging.error(
-                    "A child has died: %s. Exiting", ", ".join(dead_process_names)
+        try:
+            while not stop_event.is_set():
+                if time.monotonic() >= next_status:
+                    if config.zac.health_file is not None:
+                        write_health(
+                            config.zac.health_file,
+                            processes,
+                            source_hosts_queues,
+                            config.zabbix.failsafe,
+                        )
+                    log_process_status(processes)
+                    next_status = time.monotonic() + status_interval
+
+                # Sleep until a child dies, a signal arrives or the next status is
+                # due. The stop event has no file descriptor to wait on, so wake up
+                # at least once a second in case it is set from another thread.
+                timeout = min(max(next_status - time.monotonic(), 0), 1)
+                dead_sentinels = multiprocessing.connection.wait(
+                    [wakeup_read, *sentinels], timeout=timeout
                 )
-                stop_event.set()
-
-            time.sleep(1)
+                if wakeup_read in dead_sentinels:
+                    os.read(wakeup_read, 512)  # discard the signal numbers
+                    dead_sentinels.remove(wakeup_read)
+                if dead_sentinels:
+                    logging.error(
+                        "A child has died: %s. Exiting",
+                        ", ".join([sentinels[s].name for s in dead_sentinels]),
+                    )
+                    stop_event.set()
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+            os.close(wakeup_read)
+            os.close(wakeup_write)
 
         logging.debug(
             "Queues: %s",
@@ -241,21 +303,25 @@ def main():
             logging.info("Terminating: %s(%d)", process.name, process.pid)
             process.terminate()
 
-        alive_processes = [process for process in processes if process.is_alive()]
-        while alive_processes:
-            process = alive_processes[0]
-            logging.info("Waiting for: %s(%d)", process.name, process.pid)
+        while sentinels:
+            logging.info(
+                "Waiting for: %s",
+                ", ".join([f"{p.name}({p.pid})" for p in sentinels.values()]),
+            )
             log_process_status(processes)  # TODO: Too verbose?
-            process.join(10)
-            if process.exitcode is None:
+            deadline = time.monotonic() + 10
+            while sentinels and time.monotonic() < deadline:
+                for sentinel in multiprocessing.connection.wait(
+                    list(sentinels), timeout=deadline - time.monotonic()
+                ):
+                    sentinels.pop(sentinel).join()
+            for process in sentinels.values():
                 logging.warning(
                     "Process hanging. Signaling new terminate: %s(%d)",
                     process.name,
                     process.pid,
                 )
                 process.terminate()
-            time.sleep(1)
-            alive_processes = [process for process in processes if process.is_alive()]
 
     logging.info("Main exit")
 
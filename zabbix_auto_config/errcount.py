@@ -1,15 +1,17 @@
 from __future__ import annotations
 
 import datetime
+from collections import deque
 from dataclasses import dataclass
 from dataclasses import field
 from functools import lru_cache
 from functools import wraps
 from typing import TYPE_CHECKING
+from typing import Callable
 from typing import Optional
 
 if TYPE_CHECKING:
-    from typing import List  # noqa: F401
+    from typing import Deque  # noqa: F401
 
 
 @lru_cache()
@@ -65,9 +67,17 @@ class RollingErrorCounter:
 
     Counts errors in the last `duration` seconds. If the number of errors
     exceeds `tolerance`, the counter is disabled.
+
+    `clock` is the function used to get the current time. It can be
+    replaced to control the passage of time, e.g. in tests.
     """
 
-    def __init__(self, duration: float, tolerance: int) -> None:
+    def __init__(
+        self,
+        duration: float,
+        tolerance: int,
+        clock: Callable[[], datetime.datetime] = datetime.datetime.now,
+    ) -> None:
         if duration < 0:
             raise ValueError("duration must be a positive number")
         self.duration = duration
@@ -76,7 +86,8 @@ class RollingErrorCounter:
             raise ValueError("tolerance must be a positive integer")
         self.tolerance = tolerance
 
-        self.errors = []  # type: List[Error]
+        self.clock = clock
+        self.errors = deque()  # type: Deque[Error]
 
     @property
     def last_error(self) -> Optional[Error]:
@@ -87,7 +98,7 @@ class RollingErrorCounter:
 
     def add(self, exception: Optional[Exception] = None) -> None:
         """Add an error to the counter."""
-        self.errors.append(Error(exception=exception))
+        self.errors.append(Error(timestamp=self.clock(), exception=exception))
 
     def reset(self) -> None:
         """Reset the counter."""
@@ -95,10 +106,11 @@ class RollingErrorCounter:
 
     def count(self) -> int:
         """Return number of errors in the last duration seconds."""
-        while len(self.errors) > 0 and (
-            self.errors[0].timestamp < datetime.datetime.now() - get_td(self.duration)
-        ):
-            self.errors.pop(0)
+        # Errors are appended in chronological order, so expired errors
+        # are always at the front of the deque.
+        cutoff = self.clock() - get_td(self.duration)
+        while self.errors and self.errors[0].timestamp < cutoff:
+            self.errors.popleft()
 
         return len(self.errors)
 
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 import logging
+import operator
+import sys
 from pathlib import Path
 from typing import Any
 from typing import Dict
@@ -10,6 +12,7 @@ from typing import Set
 from typing import Tuple
 from typing import Union
 
+from pydantic import AfterValidator
 from pydantic import BaseModel
 from pydantic import BaseModel as PydanticBaseModel
 from pydantic import ConfigDict
@@ -99,6 +102,11 @@ class ZacSettings(ConfigBaseModel):
     failsafe_file: Optional[Path] = None
     failsafe_ok_file: Optional[Path] = None
     failsafe_ok_file_strict: bool = True
+    source_queue_size: int = Field(
+        1,
+        ge=1,
+        description="Number of collected host lists each source collector can queue up for the source handler.",
+    )
 
     @field_validator("health_file", "failsafe_file", "failsafe_ok_file", mode="after")
     @classmethod
@@ -194,6 +202,11 @@ class Settings(ConfigBaseModel):
     source_collectors: Dict[str, SourceCollectorSettings]
 
 
+# The same few property, siteadmin, source and tag strings are repeated across
+# thousands of hosts. Interning them makes all hosts share one copy of each.
+InternedStr = Annotated[str, AfterValidator(sys.intern)]
+
+
 class Interface(BaseModel):
     details: Optional[Dict[str, Union[int, str]]] = {}
     endpoint: str
@@ -216,11 +229,11 @@ class Host(BaseModel):
     interfaces: List[Interface] = []
     inventory: Dict[str, str] = {}
     macros: Optional[None] = None  # TODO: What should macros look like?
-    properties: Set[str] = set()
+    properties: Set[InternedStr] = set()
     proxy_pattern: Optional[str] = None  # NOTE: replace with Optional[typing.Pattern]?
-    siteadmins: Set[str] = set()
-    sources: Set[str] = set()
-    tags: Set[Tuple[str, str]] = set()
+    siteadmins: Set[InternedStr] = set()
+    sources: Set[InternedStr] = set()
+    tags: Set[Tuple[InternedStr, InternedStr]] = set()
     model_config = ConfigDict(validate_assignment=True, revalidate_instances="always")
 
     @model_validator(mode="before")
@@ -260,56 +273,77 @@ class Host(BaseModel):
         if not isinstance(other, self.__class__):
             raise TypeError(f"Can't merge with objects of other type: {type(other)}")
 
-        self.enabled = self.enabled or other.enabled
         # self.macros TODO
         self.properties.update(other.properties)
         self.siteadmins.update(other.siteadmins)
         self.sources.update(other.sources)
         self.tags.update(other.tags)
 
-        importances = [
-            importance
-            for importance in [self.importance, other.importance]
-            if importance
-        ]
-        self.importance = min(importances) if importances else None
+        if self.importance and other.importance:
+            importance = min(self.importance, other.importance)
+        else:
+            importance = self.importance or other.importance or None
 
-        self_interface_types = {i.type for i in self.interfaces}
+        interfaces = self.interfaces
+        self_interface_types = {i.type for i in interfaces}
         for other_interface in other.interfaces:
             if other_interface.type not in self_interface_types:
-                self.interfaces.append(other_interface)
+                interfaces.append(other_interface)
             else:
                 logging.warning(
                     "Trying to merge host with interface of same type. The other interface is ignored. Host: %s, type: %s",
                     self.hostname,
                     other_interface.type,
                 )
-        self.interfaces = sorted(self.interfaces, key=lambda interface: interface.type)
+        interfaces.sort(key=operator.attrgetter("type"))
 
+        inventory = self.inventory
         for k, v in other.inventory.items():
-            if k in self.inventory and v != self.inventory[k]:
+            current = inventory.get(k)  # values are never None
+            if current is None:
+                inventory[k] = v
+            elif current != v:
                 logging.warning(
                     "Same inventory ('%s') set multiple times for host: '%s'",
                     k,
                     self.hostname,
                 )
-            else:
-                self.inventory[k] = v
-
-        proxy_patterns = [
-            proxy_pattern
-            for proxy_pattern in [self.proxy_pattern, other.proxy_pattern]
-            if proxy_pattern
-        ]
-        if len(proxy_patterns) > 1:
+
+        proxy_pattern = self.proxy_pattern
+        if proxy_pattern and other.proxy_pattern:
             logging.warning(
                 "Multiple proxy patterns are provided. Discarding down to one. Host: %s",
                 self.hostname,
             )
             # TODO: Do something different? Is alphabetically first "good enough"? It will be consistent at least.
-            self.proxy_pattern = sorted(list(proxy_patterns))[0]
-        elif len(proxy_patterns) == 1:
-            self.proxy_pattern = proxy_patterns.pop()
+            proxy_pattern = min(proxy_pattern, other.proxy_pattern)
+        elif other.proxy_pattern:
+            proxy_pattern = other.proxy_pattern
+
+        # Both hosts are already valid, and every merged value is taken from one
+        # of them, so we skip assignment validation with object.__setattr__.
+        object.__setattr__(self, "enabled", self.enabled or other.enabled)
+        object.__setattr__(self, "importance", importance)
+        object.__setattr__(self, "proxy_pattern", proxy_pattern)
+
+    def copy_for_modifier(self) -> "Host":
+        """Returns a copy of the host that a host modifier can change freely.
+
+        Cheaper than a deep copy: only the mutable field values are copied,
+        since the strings and tuples they contain cannot be changed in place.
+        """
+        return self.model_copy(
+            update={
+                "interfaces": [
+                    interface.model_copy(deep=True) for interface in self.interfaces
+                ],
+                "inventory": self.inventory.copy(),
+                "properties": self.properties.copy(),
+                "siteadmins": self.siteadmins.copy(),
+                "sources": self.sources.copy(),
+                "tags": self.tags.copy(),
+            }
+        )
 
 
 class HostActions(BaseModel):
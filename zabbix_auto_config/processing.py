@@ -4,12 +4,12 @@ import datetime
 import importlib
 import itertools
 import logging
+import logging.handlers
 import multiprocessing
 import os
 import os.path
 import queue
 import random
-import re
 import signal
 import sys
 import time
@@ -17,43 +17,77 @@ from collections import Counter
 from collections import defaultdict
 from enum import Enum
 from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
 from typing import Dict
 from typing import List
 from typing import Optional
 from typing import Set
+from typing import Tuple  # noqa: F401 # used in type comments
 
 import psycopg2
 import pyzabbix
 import requests.exceptions
 from packaging.version import Version
+from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
 from pydantic import ValidationError
 
 from . import exceptions
 from . import models
 from . import utils
 from ._types import HostModifierDict
-from ._types import HostModifierModule
 from ._types import SourceCollectorModule
 from .errcount import RollingErrorCounter
 from .state import State
 
 if TYPE_CHECKING:
+    from multiprocessing.synchronize import Event
+
     from psycopg2.extensions import cursor as Cursor
 
 
 class BaseProcess(multiprocessing.Process):
-    def __init__(self, name: str, state: State):
+    def __init__(
+        self,
+        name: str,
+        state: State,
+        log_queue: Optional[multiprocessing.Queue] = None,
+    ):
         super().__init__()
         self.name = name
         self.state = state
 
+        # Log records are put on this queue and handled by the main process.
+        # Handlers are only inherited when the process is forked, so the
+        # queue handler is installed in run().
+        self.log_queue = log_queue
+        self.log_level = logging.getLogger().level
+
         self.update_interval = 1
         self.next_update = datetime.datetime.now()
 
         self.state.set_ok()
         self.stop_event = multiprocessing.Event()
 
+    def to_health_dict(self) -> Dict[str, Any]:
+        """Returns the process' entry in the health file."""
+        health = {"name": self.name, "pid": self.pid, "alive": self.is_alive()}
+        # One call to the state, which is a manager proxy in the application
+        health.update(self.state.asdict())
+        return health
+
+    def setup_logging(self) -> None:
+        """Replaces the root logger's handlers with one that puts records on `log_queue`."""
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(self.log_queue))
+        root.setLevel(self.log_level)
+
     def run(self):
+        if self.log_queue is not None:
+            self.setup_logging()
         logging.info("Process starting")
 
         with SignalHandler(self.stop_event):
@@ -63,9 +97,11 @@ class BaseProcess(multiprocessing.Process):
                     self.stop_event.set()
                     break
 
-                if self.next_update > datetime.datetime.now():
-                    # logging.debug(f"Waiting for next update {self.next_update.isoformat()}")
-                    time.sleep(1)
+                remaining = (self.next_update - datetime.datetime.now()).total_seconds()
+                if remaining > 0:
+                    # Wake up on stop right away, and at least once a second
+                    # to check that the parent is still alive
+                    self.stop_event.wait(min(remaining, 1))
                     continue
 
                 self.next_update = datetime.datetime.now() + datetime.timedelta(
@@ -126,13 +162,17 @@ class SourceCollectorProcess(BaseProcess):
         module: SourceCollectorModule,
         config: models.SourceCollectorSettings,
         source_hosts_queue: multiprocessing.Queue,
+        source_hosts_ready: Optional[Event] = None,
+        log_queue: Optional[multiprocessing.Queue] = None,
     ):
-        super().__init__(name, state)
+        super().__init__(name, state, log_queue)
         self.module = module
         self.config = config
 
         self.source_hosts_queue = source_hosts_queue
         self.source_hosts_queue.cancel_join_thread()  # Don't wait for empty queue when exiting
+        # Set after putting hosts on the queue, to wake up the source handler
+        self.source_hosts_ready = source_hosts_ready
 
         self.update_interval = self.config.update_interval
 
@@ -225,7 +265,7 @@ class SourceCollectorProcess(BaseProcess):
                     f"Collected object is not a Host object: {host!r}. Type: {type(host)}"
                 )
 
-            host.sources = set([self.name])
+            host.sources = {self.name}
             valid_hosts.append(host)
 
         source_hosts = {
@@ -238,6 +278,8 @@ class SourceCollectorProcess(BaseProcess):
             )
             utils.drain_queue(self.source_hosts_queue)
         self.source_hosts_queue.put_nowait(source_hosts)
+        if self.source_hosts_ready is not None:
+            self.source_hosts_ready.set()
 
         logging.info(
             "Done collecting %d hosts from source, '%s', in %.2f seconds. Next update: %s",
@@ -256,9 +298,43 @@ class HostAction(Enum):
     NOT_FOUND = "not_found"
 
 
+def create_indexes(db_uri: str) -> None:
+    """Creates the indexes used for hostname and source lookups if they are missing.
+
+    Run once by the main process before the processes are started."""
+    statements = [
+        "CREATE INDEX IF NOT EXISTS hosts_hostname_idx ON hosts ((data->>'hostname'))",
+        "CREATE INDEX IF NOT EXISTS hosts_source_hostname_idx ON hosts_source ((data->>'hostname'))",
+        # GIN index serves the `data->'sources' ? source` filter
+        "CREATE INDEX IF NOT EXISTS hosts_source_sources_idx ON hosts_source USING GIN ((data->'sources'))",
+    ]
+    try:
+        db_connection = psycopg2.connect(db_uri)
+    except psycopg2.Error as e:
+        logging.warning("Unable to connect to database to create indexes: %s", e)
+        return
+
+    try:
+        with db_connection, db_connection.cursor() as db_cursor:
+            for statement in statements:
+                db_cursor.execute(statement)
+    except psycopg2.Error as e:
+        logging.warning("Unable to create indexes: %s", e)
+    finally:
+        db_connection.close()
+
+
 class SourceHandlerProcess(BaseProcess):
-    def __init__(self, name, state, db_uri, source_hosts_queues):
-        super().__init__(name, state)
+    def __init__(
+        self,
+        name,
+        state,
+        db_uri,
+        source_hosts_queues,
+        source_hosts_ready,
+        log_queue=None,
+    ):
+        super().__init__(name, state, log_queue)
 
         self.db_uri = db_uri
         self.db_source_table = "hosts_source"
@@ -273,8 +349,18 @@ class SourceHandlerProcess(BaseProcess):
         self.source_hosts_queues = source_hosts_queues
         for source_hosts_queue in self.source_hosts_queues:
             source_hosts_queue.cancel_join_thread()  # Don't wait for empty queue when exiting
+        self.source_hosts_ready = source_hosts_ready
+
+        # work() blocks until a queue has data, so there is no need to sleep between calls
+        self.update_interval = 0
 
     def work(self):
+        # Wait until a source collector signals that it has put hosts on its
+        # queue. The timeout lets the run loop keep checking for stop and a
+        # dead parent, and picks up hosts that were still in flight when the
+        # event was set.
+        if self.source_hosts_ready.wait(timeout=1):
+            self.source_hosts_ready.clear()
         for source_hosts_queue in self.source_hosts_queues:
             if self.stop_event.is_set():
                 logging.debug("Told to stop. Breaking")
@@ -296,82 +382,90 @@ class SourceHandlerProcess(BaseProcess):
             )
             self.handle_source_hosts(source, hosts)
 
-    def handle_source_host(
-        self,
-        cursor: "Cursor",
-        host: models.Host,
-        current_host: Optional[models.Host],
-        source: str,
-    ) -> HostAction:
-        # TODO: still some optimizations to be done here with regards to bulk insertions/updates
-        if current_host:
-            if current_host == host:
-                return HostAction.NO_CHANGE
-            else:
-                # logging.debug(f"Replaced host <{host['hostname']}> from source <{source}>")
-                cursor.execute(
-                    f"UPDATE {self.db_source_table} SET data = %s WHERE data->>'hostname' = %s AND data->'sources' ? %s",
-                    [host.model_dump_json(), host.hostname, source],
-                )
-                return HostAction.UPDATE
-        else:
-            # logging.debug(f"Inserted host <{host['hostname']}> from source <{source}>")
-            cursor.execute(
-                f"INSERT INTO {self.db_source_table} (data) VALUES (%s)",
-                [host.model_dump_json()],
-            )
-            return HostAction.INSERT
-
     def get_current_source_hosts(
         self, cursor: "Cursor", source: str
-    ) -> Dict[str, models.Host]:
-        hosts = {}  # type: Dict[str, models.Host]
+    ) -> Dict[str, Dict[str, Any]]:
+        """Returns the stored (unvalidated) host documents of a source, keyed by hostname."""
         cursor.execute(
             f"SELECT data FROM {self.db_source_table} WHERE data->'sources' ? %s",
             [source],
         )
-        for result in cursor.fetchall():
-            try:
-                host = models.Host(**result[0])
-            except ValidationError as e:
-                # TODO: ensure this actually identifies the faulty host
-                logging.exception("Invalid host in source hosts table: %s", e)
-            except Exception as e:
-                logging.exception(
-                    "Error when parsing host from source hosts table: %s", e
+        hosts = {}  # type: Dict[str, Dict[str, Any]]
+        for (data,) in cursor:
+            # The documents are validated later, but we need a hostname to key them by
+            hostname = data.get("hostname") if isinstance(data, dict) else None
+            if not isinstance(hostname, str):
+                logging.error(
+                    "Invalid host in source hosts table (no hostname): %s", data
                 )
-            else:
-                hosts[host.hostname] = host
+                continue
+            hosts[hostname] = data
         return hosts
 
+    def parse_source_host(self, data: Dict[str, Any]) -> Optional[models.Host]:
+        try:
+            return models.Host.model_validate(data)
+        except ValidationError as e:
+            # TODO: ensure this actually identifies the faulty host
+            logging.exception("Invalid host in source hosts table: %s", e)
+        except Exception as e:
+            logging.exception("Error when parsing host from source hosts table: %s", e)
+        return None
+
     def handle_source_hosts(self, source: str, hosts: List[models.Host]) -> None:
         start_time = time.time()
 
         actions = Counter()  # type: Counter[HostAction]
 
         source_hostnames = {host.hostname for host in hosts}
+        # Diff against the current hosts and write all changes in one transaction
         with self.db_connection, self.db_connection.cursor() as db_cursor:
-            db_cursor.execute(
-                f"SELECT DISTINCT data->>'hostname' FROM {self.db_source_table} WHERE data->'sources' ? %s",
-                [source],
-            )
-            current_hostnames = {t[0] for t in db_cursor.fetchall()}
+            current_hosts = self.get_current_source_hosts(db_cursor, source)
 
-        removed_hostnames = current_hostnames - source_hostnames
-        with self.db_connection, self.db_connection.cursor() as db_cursor:
-            for removed_hostname in removed_hostnames:
+            removed_hostnames = current_hosts.keys() - source_hostnames
+            if removed_hostnames:
                 db_cursor.execute(
-                    f"DELETE FROM {self.db_source_table} WHERE data->>'hostname' = %s AND data->'sources' ? %s",
-                    [removed_hostname, source],
+                    f"DELETE FROM {self.db_source_table} WHERE data->>'hostname' = ANY(%s) AND data->'sources' ? %s",
+                    [list(removed_hostnames), source],
                 )
-                actions[HostAction.DELETE] += 1
+                actions[HostAction.DELETE] += len(removed_hostnames)
 
-        with self.db_connection, self.db_connection.cursor() as db_cursor:
-            current_hosts = self.get_current_source_hosts(db_cursor, source)
+            inserts = []  # type: List[Tuple[str]]
+            updates = []  # type: List[Tuple[str, str, str]]
             for host in hosts:
-                current_host = current_hosts.get(host.hostname)
-                action = self.handle_source_host(db_cursor, host, current_host, source)
-                actions[action] += 1
+                current_data = current_hosts.get(host.hostname)
+                if current_data is None:
+                    inserts.append((host.model_dump_json(),))
+                    actions[HostAction.INSERT] += 1
+                    continue
+                # Most hosts are unchanged between collections, and their stored
+                # document is then usually identical to the serialized host.
+                # Comparing the plain dicts first saves validating the document.
+                if current_data == host.model_dump(mode="json"):
+                    actions[HostAction.NO_CHANGE] += 1
+                    continue
+                # Set ordering may differ, so compare as models before updating.
+                # An invalid stored host is overwritten.
+                if self.parse_source_host(current_data) != host:
+                    updates.append((host.model_dump_json(), host.hostname, source))
+                    actions[HostAction.UPDATE] += 1
+                else:
+                    actions[HostAction.NO_CHANGE] += 1
+
+            # One statement for all inserts and one batch for all updates,
+            # instead of a round trip per host
+            if inserts:
+                execute_values(
+                    db_cursor,
+                    f"INSERT INTO {self.db_source_table} (data) VALUES %s",
+                    inserts,
+                )
+            if updates:
+                execute_batch(
+                    db_cursor,
+                    f"UPDATE {self.db_source_table} SET data = %s WHERE data->>'hostname' = %s AND data->'sources' ? %s",
+                    updates,
+                )
 
         logging.info(
             "Done handling hosts from source, '%s', in %.2f seconds. Equal hosts: %d, replaced hosts: %d, inserted hosts: %d, removed hosts: %d. Next update: %s",
@@ -386,8 +480,8 @@ class SourceHandlerProcess(BaseProcess):
 
 
 class SourceMergerProcess(BaseProcess):
-    def __init__(self, name, state, db_uri, host_modifier_dir):
-        super().__init__(name, state)
+    def __init__(self, name, state, db_uri, host_modifier_dir, log_queue=None):
+        super().__init__(name, state, log_queue)
 
         self.db_uri = db_uri
         self.db_source_table = "hosts_source"
@@ -411,14 +505,16 @@ class SourceMergerProcess(BaseProcess):
         self.update_interval = 60
 
     def get_host_modifiers(self) -> List[HostModifierDict]:
-        sys.path.append(self.host_modifier_dir)
+        if self.host_modifier_dir not in sys.path:
+            sys.path.append(self.host_modifier_dir)
 
         try:
-            module_names = [
-                filename[:-3]
-                for filename in os.listdir(self.host_modifier_dir)
-                if filename.endswith(".py")
-            ]
+            with os.scandir(self.host_modifier_dir) as entries:
+                module_names = [
+                    entry.name[:-3]
+                    for entry in entries
+                    if entry.name.endswith(".py") and entry.is_file()
+                ]
         except FileNotFoundError:
             logging.error(
                 "Host modififier directory %s does not exist.", self.host_modifier_dir
@@ -430,7 +526,7 @@ class SourceMergerProcess(BaseProcess):
         for module_name in module_names:
             module = importlib.import_module(module_name)
 
-            if not isinstance(module, HostModifierModule):
+            if not utils.has_callable(module, "modify"):
                 logging.warning(
                     "Module '%s' is not a valid host modifier module. Skipping.",
                     module_name,
@@ -460,19 +556,13 @@ class SourceMergerProcess(BaseProcess):
             merged_host.merge(host)
         return merged_host
 
-    def handle_host(
-        self,
-        cursor: "Cursor",
-        current_host: Optional[models.Host],
-        source_hosts: List[models.Host],
-    ) -> HostAction:
+    def get_merged_host(self, source_hosts: List[models.Host]) -> models.Host:
+        """Merges the source hosts of a hostname and runs the host modifiers on the result."""
         host = self.merge_hosts(source_hosts)
 
         for host_modifier in self.host_modifiers:
             try:
-                modified_host = host_modifier["module"].modify(
-                    host.model_copy(deep=True)
-                )
+                modified_host = host_modifier["module"].modify(host.copy_for_modifier())
                 assert isinstance(
                     modified_host, models.Host
                 ), f"Modifier returned invalid type: {type(modified_host)}"
@@ -497,48 +587,39 @@ class SourceMergerProcess(BaseProcess):
                 )
                 # TODO: Do more?
 
-        if current_host:
-            if current_host == host:
-                # logging.debug(f"Host <{host['hostname']}> from source <{source}> is equal to current host")
-                return HostAction.NO_CHANGE
-            else:
-                # logging.debug(f"Replaced host <{host['hostname']}> from source <{source}>")
-                cursor.execute(
-                    f"UPDATE {self.db_hosts_table} SET data = %s WHERE data->>'hostname' = %s",
-                    [host.model_dump_json(), host.hostname],
-                )
-                return HostAction.UPDATE
-        else:
-            # logging.debug(f"Inserted host <{host['hostname']}> from source <{source}>")
-            cursor.execute(
-                f"INSERT INTO {self.db_hosts_table} (data) VALUES (%s)",
-                [host.model_dump_json()],
-            )
-            return HostAction.INSERT
+        return host
 
     def get_source_hosts(self, cursor: "Cursor") -> Dict[str, List[models.Host]]:
-        cursor.execute(f"SELECT data FROM {self.db_source_table}")
-        source_hosts = defaultdict(list)  # type: Dict[str, List[models.Host]]
-        for host in cursor.fetchall():
-            try:
-                host_model = models.Host(**host[0])
-            except ValidationError as e:
-                # TODO: ensure this actually identifies the faulty host
-                logging.exception("Invalid host in source hosts table: %s", e)
-            except Exception as e:
-                logging.exception(
-                    "Error when parsing host from source hosts table: %s", e
-                )
-            else:
-                source_hosts[host_model.hostname].append(host_model)
+        # Let the database group the rows by hostname, so each hostname's
+        # source hosts arrive together as a single JSON array
+        cursor.execute(
+            f"SELECT data->>'hostname', jsonb_agg(data) FROM {self.db_source_table} GROUP BY data->>'hostname'"
+        )
+        source_hosts = {}  # type: Dict[str, List[models.Host]]
+        for hostname, rows in cursor:
+            hosts = []  # type: List[models.Host]
+            for row in rows:
+                try:
+                    host_model = models.Host.model_validate(row)
+                except ValidationError as e:
+                    # TODO: ensure this actually identifies the faulty host
+                    logging.exception("Invalid host in source hosts table: %s", e)
+                except Exception as e:
+                    logging.exception(
+                        "Error when parsing host from source hosts table: %s", e
+                    )
+                else:
+                    hosts.append(host_model)
+            # Empty if none of the hostname's source hosts are valid
+            source_hosts[hostname] = hosts
         return source_hosts
 
     def get_hosts(self, cursor: "Cursor") -> Dict[str, models.Host]:
         cursor.execute(f"SELECT data FROM {self.db_hosts_table}")
         hosts = {}  # type: Dict[str, models.Host]
-        for host in cursor.fetchall():
+        for host in cursor:
             try:
-                host_model = models.Host(**host[0])
+                host_model = models.Host.model_validate(host[0])
             except ValidationError as e:
                 # TODO: ensure this log actually identifies the faulty host
                 logging.exception("Invalid host in hosts table: %s", e)
@@ -553,49 +634,57 @@ class SourceMergerProcess(BaseProcess):
         logging.info("Merge starting")
         actions = Counter()  # type: Counter[HostAction]
 
+        # Let the database find and delete the hosts that no source has anymore
         with self.db_connection, self.db_connection.cursor() as db_cursor:
             db_cursor.execute(
-                f"SELECT DISTINCT data->>'hostname' FROM {self.db_source_table}"
-            )
-            source_hostnames = {t[0] for t in db_cursor.fetchall()}
-            db_cursor.execute(
-                f"SELECT DISTINCT data->>'hostname' FROM {self.db_hosts_table}"
+                f"DELETE FROM {self.db_hosts_table} AS h WHERE NOT EXISTS "
+                f"(SELECT 1 FROM {self.db_source_table} AS s WHERE s.data->>'hostname' = h.data->>'hostname')"
             )
-            current_hostnames = {t[0] for t in db_cursor.fetchall()}
-
-        # TODO: refactor to bulk delete
-        removed_hostnames = current_hostnames - source_hostnames
-        with self.db_connection, self.db_connection.cursor() as db_cursor:
-            for removed_hostname in removed_hostnames:
-                if self.stop_event.is_set():
-                    logging.debug("Told to stop. Breaking")
-                    break
-                db_cursor.execute(
-                    f"DELETE FROM {self.db_hosts_table} WHERE data->>'hostname' = %s",
-                    [removed_hostname],
-                )
-                actions[HostAction.DELETE] += 1
+            actions[HostAction.DELETE] += db_cursor.rowcount
 
         # Update all hosts in a single transaction for performance
         with self.db_connection, self.db_connection.cursor() as db_cursor:
             source_hosts_map = self.get_source_hosts(db_cursor)
             hosts = self.get_hosts(db_cursor)
-            for hostname in source_hostnames:
+            inserts = []  # type: List[Tuple[str]]
+            updates = []  # type: List[Tuple[str, str]]
+            for hostname, source_hosts in source_hosts_map.items():
                 # NOTE: Should we finish handling all hosts before stopping?
                 if self.stop_event.is_set():
                     logging.debug("Told to stop. Breaking")
                     break
 
-                source_hosts = source_hosts_map.get(hostname)
-                host = hosts.get(hostname)
                 if not source_hosts:
                     logging.warning(
-                        "Host '%s' not found in source hosts table", hostname
+                        "No valid hosts for '%s' in source hosts table", hostname
                     )
                     continue
 
-                host_action = self.handle_host(db_cursor, host, source_hosts)
-                actions[host_action] += 1
+                host = self.get_merged_host(source_hosts)
+                current_host = hosts.get(hostname)
+                if current_host is None:
+                    inserts.append((host.model_dump_json(),))
+                    actions[HostAction.INSERT] += 1
+                elif current_host != host:
+                    updates.append((host.model_dump_json(), hostname))
+                    actions[HostAction.UPDATE] += 1
+                else:
+                    actions[HostAction.NO_CHANGE] += 1
+
+            # Write all changes with one statement for inserts and one batch
+            # for updates instead of a round trip per host
+            if inserts:
+                execute_values(
+                    db_cursor,
+                    f"INSERT INTO {self.db_hosts_table} (data) VALUES %s",
+                    inserts,
+                )
+            if updates:
+                execute_batch(
+                    db_cursor,
+                    f"UPDATE {self.db_hosts_table} SET data = %s WHERE data->>'hostname' = %s",
+                    updates,
+                )
 
         logging.info(
             "Done with merge in %.2f seconds. Equal hosts: %d, replaced hosts: %d, inserted hosts: %d, removed hosts: %d. Next update: %s",
@@ -609,8 +698,8 @@ class SourceMergerProcess(BaseProcess):
 
 
 class ZabbixUpdater(BaseProcess):
-    def __init__(self, name, state, db_uri, settings: models.Settings):
-        super().__init__(name, state)
+    def __init__(self, name, state, db_uri, settings: models.Settings, log_queue=None):
+        super().__init__(name, state, log_queue)
 
         self.db_uri = db_uri
         self.db_hosts_table = "hosts"
@@ -657,6 +746,19 @@ class ZabbixUpdater(BaseProcess):
         self.siteadmin_hostgroup_map = utils.read_map_file(
             os.path.join(self.config.map_dir, "siteadmin_hostgroup_map.txt")
         )
+        # All template and host group names found in the map files. The maps
+        # are only read at startup, so these never change.
+        self.mapped_template_names = frozenset(
+            itertools.chain.from_iterable(self.property_template_map.values())
+        )
+        self.mapped_hostgroup_names = frozenset(
+            itertools.chain.from_iterable(
+                itertools.chain(
+                    self.property_hostgroup_map.values(),
+                    self.siteadmin_hostgroup_map.values(),
+                )
+            )
+        )
 
         ver = self.api.apiinfo.version()
         self.zabbix_version = Version(ver)
@@ -671,58 +773,89 @@ class ZabbixUpdater(BaseProcess):
             self.next_update.isoformat(timespec="seconds"),
         )
 
+    def get_db_hosts(
+        self, fields: Optional[List[str]] = None
+    ) -> Dict[str, models.Host]:
+        """Fetches all enabled hosts from the database, keyed by hostname.
+
+        If `fields` is given, only those fields (in addition to hostname and
+        enabled) are fetched. The remaining fields get their default values."""
+        if fields is None:
+            query = f"SELECT data FROM {self.db_hosts_table} WHERE data->>'enabled' = 'true'"
+            params = []  # type: List[str]
+        else:
+            # Project the fields in the database so the rest of each
+            # document is never transferred or validated
+            fields = ["hostname", "enabled", *fields]
+            pairs = ", ".join(["%s, data->%s"] * len(fields))
+            query = f"SELECT jsonb_build_object({pairs}) FROM {self.db_hosts_table} WHERE data->>'enabled' = 'true'"
+            params = [field for field in fields for _ in range(2)]
+        with self.db_connection, self.db_connection.cursor() as db_cursor:
+            db_cursor.execute(query, params)
+            return {
+                t[0]["hostname"]: models.Host.model_validate(t[0]) for t in db_cursor
+            }
+
     def do_update(self):
         pass
 
 
 class ZabbixHostUpdater(ZabbixUpdater):
-    def disable_host(self, zabbix_host):
-        if not self.config.dryrun:
-            try:
-                disabled_hostgroup_id = self.api.hostgroup.get(
-                    filter={"name": self.config.hostgroup_disabled}
-                )[0]["groupid"]
-                self.api.host.update(
-                    hostid=zabbix_host["hostid"],
-                    status=1,
-                    templates=[],
-                    groups=[{"groupid": disabled_hostgroup_id}],
-                )
+    def get_hostgroup_id(self, hostgroup_name: str) -> Optional[str]:
+        hostgroups = self.api.hostgroup.get(
+            filter={"name": hostgroup_name}, output=["groupid"]
+        )
+        return hostgroups[0]["groupid"] if hostgroups else None
+
+    def disable_hosts(self, zabbix_hosts):
+        if self.config.dryrun:
+            for zabbix_host in zabbix_hosts:
                 logging.info(
-                    "Disabling host: '%s' (%s)",
+                    "DRYRUN: Disabling host: '%s' (%s)",
                     zabbix_host["host"],
                     zabbix_host["hostid"],
                 )
-            except pyzabbix.ZabbixAPIException as e:
-                logging.error(
-                    "Error when disabling host '%s' (%s): %s",
-                    zabbix_host["host"],
-                    zabbix_host["hostid"],
-                    e.args,
-                )
-            except IndexError:
-                logging.critical(
-                    "Disabled host group '%s' does not exist in Zabbix. Cannot disable host '%s'",
-                    self.config.hostgroup_disabled,
-                    zabbix_host.get("host"),
-                )
-                self.stop_event.set()
-        else:
+            return
+
+        disabled_hostgroup_id = self.get_hostgroup_id(self.config.hostgroup_disabled)
+        if disabled_hostgroup_id is None:
+            logging.critical(
+                "Disabled host group '%s' does not exist in Zabbix. Cannot disable hosts: %s",
+                self.config.hostgroup_disabled,
+                ", ".join([zabbix_host["host"] for zabbix_host in zabbix_hosts]),
+            )
+            self.stop_event.set()
+            return
+
+        try:
+            # Disable all the hosts with a single request
+            self.api.host.massupdate(
+                hosts=[
+                    {"hostid": zabbix_host["hostid"]} for zabbix_host in zabbix_hosts
+                ],
+                status=1,
+                templates=[],
+                groups=[{"groupid": disabled_hostgroup_id}],
+            )
+        except pyzabbix.ZabbixAPIException as e:
+            logging.error(
+                "Error when disabling hosts %s: %s",
+                ", ".join([zabbix_host["host"] for zabbix_host in zabbix_hosts]),
+                e.args,
+            )
+            return
+        for zabbix_host in zabbix_hosts:
             logging.info(
-                "DRYRUN: Disabling host: '%s' (%s)",
+                "Disabling host: '%s' (%s)",
                 zabbix_host["host"],
                 zabbix_host["hostid"],
             )
 
-    def enable_host(self, db_host):
+    def enable_host(self, db_host, hostgroup_id):
         # TODO: Set correct proxy when enabling
         hostname = db_host.hostname
         if not self.config.dryrun:
             try:
-                hostgroup_id = self.api.hostgroup.get(
-                    filter={"name": self.config.hostgroup_all}
-                )[0]["groupid"]
-
                 hosts = self.api.host.get(filter={"name": hostname})
                 if hosts:
                     host = hosts[0]
@@ -756,13 +889,6 @@ class ZabbixHostUpdater(ZabbixUpdater):
                 logging.error(
                     "Error when enabling/creating host '%s': %s", hostname, e.args
                 )
-            except IndexError:
-                logging.critical(
-                    "Enabled host group '%s' does not exist in Zabbix. Cannot enable host '%s'",
-                    self.config.hostgroup_all,
-                    hostname,
-                )
-                self.stop_event.set()
         else:
             logging.info("DRYRUN: Enabling host: '%s'", hostname)
 
@@ -948,13 +1074,7 @@ class ZabbixHostUpdater(ZabbixUpdater):
         return True
 
     def do_update(self):
-        with self.db_connection, self.db_connection.cursor() as db_cursor:
-            db_cursor.execute(
-                f"SELECT data FROM {self.db_hosts_table} WHERE data->>'enabled' = 'true'"
-            )
-            db_hosts = {
-                t[0]["hostname"]: models.Host(**t[0]) for t in db_cursor.fetchall()
-            }
+        db_hosts = self.get_db_hosts()
         # status:0 = monitored, flags:0 = non-discovered host
         zabbix_hosts = {
             host["host"]: host
@@ -988,6 +1108,11 @@ class ZabbixHostUpdater(ZabbixUpdater):
             proxy["host"]: proxy
             for proxy in self.api.proxy.get(output=["proxyid", "host", "status"])
         }
+        zabbix_proxies_by_id = {
+            proxy["proxyid"]: proxy for proxy in zabbix_proxies.values()
+        }
+        # Many hosts share a proxy pattern, so match each pattern once per run
+        proxies_by_pattern = {}  # type: Dict[str, List[Dict[str, Any]]]
         zabbix_managed_hosts = []
         zabbix_manual_hosts = []
 
@@ -1040,19 +1165,29 @@ class ZabbixHostUpdater(ZabbixUpdater):
         ):
             self.handle_failsafe_limit(hostnames_to_add, hostnames_to_remove)
 
-        for hostname in hostnames_to_remove:
-            if self.stop_event.is_set():
-                logging.debug("Told to stop. Breaking")
-                break
-            zabbix_host = zabbix_hosts[hostname]
-            self.disable_host(zabbix_host)
+        if hostnames_to_remove and not self.stop_event.is_set():
+            self.disable_hosts(
+                [zabbix_hosts[hostname] for hostname in hostnames_to_remove]
+            )
+
+        # Look up the host group once instead of once per enabled host
+        enabled_hostgroup_id = None
+        if hostnames_to_add and not self.config.dryrun:
+            enabled_hostgroup_id = self.get_hostgroup_id(self.config.hostgroup_all)
+            if enabled_hostgroup_id is None:
+                logging.critical(
+                    "Enabled host group '%s' does not exist in Zabbix. Cannot enable hosts: %s",
+                    self.config.hostgroup_all,
+                    ", ".join(hostnames_to_add),
+                )
+                self.stop_event.set()
 
         for hostname in hostnames_to_add:
             if self.stop_event.is_set():
                 logging.debug("Told to stop. Breaking")
                 break
             db_host = db_hosts[hostname]
-            self.enable_host(db_host)
+            self.enable_host(db_host, enabled_hostgroup_id)
 
         for hostname in hostnames_in_both:
             # Check if these hosts are good
@@ -1065,19 +1200,17 @@ class ZabbixHostUpdater(ZabbixUpdater):
             zabbix_host = zabbix_hosts[hostname]
 
             # Check proxy. A host with proxy_pattern should get a proxy that matches the pattern.
-            zabbix_proxy_id = zabbix_host["proxy_hostid"]
-            zabbix_proxy = [
-                proxy
-                for proxy in zabbix_proxies.values()
-                if proxy["proxyid"] == zabbix_proxy_id
-            ]
-            current_zabbix_proxy = zabbix_proxy[0] if zabbix_proxy else None
+            current_zabbix_proxy = zabbix_proxies_by_id.get(zabbix_host["proxy_hostid"])
             if db_host.proxy_pattern:
-                possible_proxies = [
-                    proxy
-                    for proxy in zabbix_proxies.values()
-                    if re.match(db_host.proxy_pattern, proxy["host"])
-                ]
+                proxy_pattern = utils.compile_pattern(db_host.proxy_pattern)
+                possible_proxies = proxies_by_pattern.get(db_host.proxy_pattern)
+                if possible_proxies is None:
+                    possible_proxies = [
+                        proxy
+                        for proxy in zabbix_proxies.values()
+                        if proxy_pattern.match(proxy["host"])
+                    ]
+                    proxies_by_pattern[db_host.proxy_pattern] = possible_proxies
                 if not possible_proxies:
                     logging.error(
                         "Proxy pattern ('%s') for host, '%s' (%s), doesn't match any proxies.",
@@ -1087,8 +1220,8 @@ class ZabbixHostUpdater(ZabbixUpdater):
                     )
                 else:
                     new_proxy = random.choice(possible_proxies)
-                    if current_zabbix_proxy and not re.match(
-                        db_host.proxy_pattern, current_zabbix_proxy["host"]
+                    if current_zabbix_proxy and not proxy_pattern.match(
+                        current_zabbix_proxy["host"]
                     ):
                         # Wrong proxy, set new
                         self.set_proxy(zabbix_host, new_proxy)
@@ -1254,57 +1387,58 @@ class ZabbixHostUpdater(ZabbixUpdater):
 
 
 class ZabbixTemplateUpdater(ZabbixUpdater):
-    def clear_templates(self, templates, host):
-        logging.debug("Clearing templates on host: '%s'", host["host"])
+    def clear_template(self, template_name, template_id, hosts):
+        hostnames = ", ".join([host["host"] for host in hosts])
         if not self.config.dryrun:
+            logging.debug(
+                "Clearing template '%s' on hosts: %s", template_name, hostnames
+            )
             try:
-                templates = [
-                    {"templateid": template_id} for _, template_id in templates.items()
-                ]
-                self.api.host.update(hostid=host["hostid"], templates_clear=templates)
+                self.api.host.massremove(
+                    hostids=[host["hostid"] for host in hosts],
+                    templateids_clear=[template_id],
+                )
             except pyzabbix.ZabbixAPIException as e:
                 logging.error(
-                    "Error when clearing templates on host '%s': %s",
-                    host["host"],
+                    "Error when clearing template '%s' on hosts %s: %s",
+                    template_name,
+                    hostnames,
                     e.args,
                 )
         else:
-            logging.debug("DRYRUN: Clearing templates on host: '%s'", host["host"])
+            logging.debug(
+                "DRYRUN: Clearing template '%s' on hosts: %s", template_name, hostnames
+            )
 
-    def set_templates(self, templates, host):
+    def add_template(self, template_name, template_id, hosts):
+        hostnames = ", ".join([host["host"] for host in hosts])
         if not self.config.dryrun:
-            logging.debug("Setting templates on host: '%s'", host["host"])
+            logging.debug("Adding template '%s' to hosts: %s", template_name, hostnames)
             try:
-                templates = [
-                    {"templateid": template_id} for _, template_id in templates.items()
-                ]
-                self.api.host.update(hostid=host["hostid"], templates=templates)
+                self.api.host.massadd(
+                    hosts=[{"hostid": host["hostid"]} for host in hosts],
+                    templates=[{"templateid": template_id}],
+                )
             except pyzabbix.ZabbixAPIException as e:
                 logging.error(
-                    "Error when setting templates on host '%s': %s",
-                    host["host"],
+                    "Error when adding template '%s' to hosts %s: %s",
+                    template_name,
+                    hostnames,
                     e.args,
                 )
         else:
-            logging.debug("DRYRUN: Setting templates on host: '%s'", host["host"])
+            logging.debug(
+                "DRYRUN: Adding template '%s' to hosts: %s", template_name, hostnames
+            )
 
     def do_update(self):
-        managed_template_names = set(
-            itertools.chain.from_iterable(self.property_template_map.values())
-        )
         zabbix_templates = {}
         for zabbix_template in self.api.template.get(output=["host", "templateid"]):
             zabbix_templates[zabbix_template["host"]] = zabbix_template["templateid"]
-        managed_template_names = managed_template_names.intersection(
-            set(zabbix_templates.keys())
-        )  # If the template isn't in zabbix we can't manage it
-        with self.db_connection, self.db_connection.cursor() as db_cursor:
-            db_cursor.execute(
-                f"SELECT data FROM {self.db_hosts_table} WHERE data->>'enabled' = 'true'"
-            )
-            db_hosts = {
-                t[0]["hostname"]: models.Host(**t[0]) for t in db_cursor.fetchall()
-            }
+        zabbix_template_names = zabbix_templates.keys()
+        # If the template isn't in zabbix we can't manage it
+        managed_template_names = self.mapped_template_names & zabbix_template_names
+        db_hosts = self.get_db_hosts(fields=["properties"])
         zabbix_hosts = {
             host["host"]: host
             for host in self.api.host.get(
@@ -1315,6 +1449,10 @@ class ZabbixTemplateUpdater(ZabbixUpdater):
             )
         }
 
+        # Hosts to change per template, so each template is changed with one request
+        templates_to_clear = defaultdict(list)  # type: Dict[str, List[Dict[str, Any]]]
+        templates_to_add = defaultdict(list)  # type: Dict[str, List[Dict[str, Any]]]
+
         for zabbix_hostname, zabbix_host in zabbix_hosts.items():
             if self.stop_event.is_set():
                 logging.debug("Told to stop. Breaking")
@@ -1344,16 +1482,14 @@ class ZabbixTemplateUpdater(ZabbixUpdater):
             for _property in db_host.properties:
                 if _property in self.property_template_map:
                     synced_template_names.update(self.property_template_map[_property])
-            synced_template_names = synced_template_names.intersection(
-                set(zabbix_templates.keys())
-            )  # If the template isn't in zabbix we can't manage it
+            # If the template isn't in zabbix we can't manage it
+            synced_template_names &= zabbix_template_names
 
             host_templates = {}
             for zabbix_template in zabbix_host["parentTemplates"]:
                 host_templates[zabbix_template["host"]] = zabbix_template["templateid"]
 
             old_host_templates = host_templates.copy()
-            host_templates_to_remove = {}
 
             for template_name in list(host_templates.keys()):
                 if (
@@ -1365,9 +1501,7 @@ class ZabbixTemplateUpdater(ZabbixUpdater):
                         template_name,
                         zabbix_hostname,
                     )
-                    host_templates_to_remove[template_name] = host_templates[
-                        template_name
-                    ]
+                    templates_to_clear[template_name].append(zabbix_host)
                     del host_templates[template_name]
             for template_name in synced_template_names:
                 if template_name not in host_templates.keys():
@@ -1376,6 +1510,7 @@ class ZabbixTemplateUpdater(ZabbixUpdater):
                         template_name,
                         zabbix_hostname,
                     )
+                    templates_to_add[template_name].append(zabbix_host)
                     host_templates[template_name] = zabbix_templates[template_name]
 
             if host_templates != old_host_templates:
@@ -1385,30 +1520,96 @@ class ZabbixTemplateUpdater(ZabbixUpdater):
                     ", ".join(old_host_templates.keys()),
                     ", ".join(host_templates.keys()),
                 )
-                if host_templates_to_remove:
-                    self.clear_templates(host_templates_to_remove, zabbix_host)
-                # TODO: Setting templates might not be necessary if we only removed templates. Consider refactor
-                # TODO: Setting templates should not be performed if template clearing has failed (will lead to unlink without clear)
-                self.set_templates(host_templates, zabbix_host)
+
+        # Clear removed templates before linking new ones, as host.update did
+        for template_name, hosts in templates_to_clear.items():
+            self.clear_template(template_name, zabbix_templates[template_name], hosts)
+        for template_name, hosts in templates_to_add.items():
+            self.add_template(template_name, zabbix_templates[template_name], hosts)
 
 
 class ZabbixHostgroupUpdater(ZabbixUpdater):
-    def set_hostgroups(self, hostgroups, host):
+    def add_hostgroup(self, hostgroup_name, hostgroup_id, hosts):
+        hostnames = ", ".join([host["host"] for host in hosts])
+        if not self.config.dryrun:
+            logging.debug(
+                "Adding hostgroup '%s' to hosts: %s", hostgroup_name, hostnames
+            )
+            self.mass_update_hosts(
+                lambda hosts: self.api.hostgroup.massadd(
+                    groups=[{"groupid": hostgroup_id}],
+                    hosts=[{"hostid": host["hostid"]} for host in hosts],
+                ),
+                hosts,
+                f"adding hostgroup '{hostgroup_name}'",
+            )
+        else:
+            logging.debug(
+                "DRYRUN: Adding hostgroup '%s' to hosts: %s", hostgroup_name, hostnames
+            )
+
+    def remove_hostgroup(self, hostgroup_name, hostgroup_id, hosts):
+        hostnames = ", ".join([host["host"] for host in hosts])
         if not self.config.dryrun:
-            logging.debug("Setting hostgroups on host: '%s'", host["host"])
+            logging.debug(
+                "Removing hostgroup '%s' from hosts: %s", hostgroup_name, hostnames
+            )
+            self.mass_update_hosts(
+                lambda hosts: self.api.hostgroup.massremove(
+                    groupids=[hostgroup_id],
+                    hostids=[host["hostid"] for host in hosts],
+                ),
+                hosts,
+                f"removing hostgroup '{hostgroup_name}'",
+            )
+        else:
+            logging.debug(
+                "DRYRUN: Removing hostgroup '%s' from hosts: %s",
+                hostgroup_name,
+                hostnames,
+            )
+
+    def mass_update_hosts(
+        self,
+        update: Callable[[List[Dict[str, Any]]], Any],
+        hosts: List[Dict[str, Any]],
+        description: str,
+    ) -> None:
+        """Calls `update` with all `hosts` in one request. If the request fails,
+        retries one host at a time, so that a single failing host does not
+        block the others, and logs each host that fails."""
+        try:
+            update(hosts)
+            return
+        except pyzabbix.ZabbixAPIException as e:
+            if len(hosts) > 1:
+                logging.warning(
+                    "Error when %s for %d hosts. Retrying one host at a time: %s",
+                    description,
+                    len(hosts),
+                    e.args,
+                )
+            else:
+                logging.error(
+                    "Error when %s for host '%s' (%s): %s",
+                    description,
+                    hosts[0]["host"],
+                    hosts[0]["hostid"],
+                    e.args,
+                )
+                return
+
+        for host in hosts:
             try:
-                groups = [
-                    {"groupid": hostgroup_id} for _, hostgroup_id in hostgroups.items()
-                ]
-                self.api.host.update(hostid=host["hostid"], groups=groups)
+                update([host])
             except pyzabbix.ZabbixAPIException as e:
                 logging.error(
-                    "Error when setting hostgroups on host '%s': %s",
+                    "Error when %s for host '%s' (%s): %s",
+                    description,
                     host["host"],
+                    host["hostid"],
                     e.args,
                 )
-        else:
-            logging.debug("DRYRUN: Setting hostgroups on host: '%s'", host["host"])
 
     def create_hostgroup(self, hostgroup_name: str) -> Optional[str]:
         if self.config.dryrun:
@@ -1436,7 +1637,7 @@ class ZabbixHostgroupUpdater(ZabbixUpdater):
 
         for prefix in self.config.extra_siteadmin_hostgroup_prefixes:
             mapping = utils.mapping_values_with_prefix(
-                self.siteadmin_hostgroup_map,  # this is copied in the function
+                self.siteadmin_hostgroup_map,  # not modified by the function
                 prefix=prefix,
             )
             for hostgroups in mapping.values():
@@ -1522,12 +1723,7 @@ class ZabbixHostgroupUpdater(ZabbixUpdater):
             self.create_hostgroup(tgroup)
 
     def do_update(self):
-        managed_hostgroup_names = set(
-            itertools.chain.from_iterable(self.property_hostgroup_map.values())
-        )
-        managed_hostgroup_names.update(
-            itertools.chain.from_iterable(self.siteadmin_hostgroup_map.values())
-        )
+        managed_hostgroup_names = set(self.mapped_hostgroup_names)
 
         existing_hostgroups = self.api.hostgroup.get(output=["name", "groupid"])
 
@@ -1550,13 +1746,9 @@ class ZabbixHostgroupUpdater(ZabbixUpdater):
                 managed_hostgroup_names.add(zabbix_hostgroup["name"])
         managed_hostgroup_names.update([self.config.hostgroup_all])
 
-        with self.db_connection, self.db_connection.cursor() as db_cursor:
-            db_cursor.execute(
-                f"SELECT data FROM {self.db_hosts_table} WHERE data->>'enabled' = 'true'"
-            )
-            db_hosts = {
-                t[0]["hostname"]: models.Host(**t[0]) for t in db_cursor.fetchall()
-            }
+        db_hosts = self.get_db_hosts(
+            fields=["importance", "properties", "siteadmins", "sources"]
+        )
         zabbix_hosts = {
             host["host"]: host
             for host in self.api.host.get(
@@ -1567,14 +1759,27 @@ class ZabbixHostgroupUpdater(ZabbixUpdater):
             )
         }
 
+        # Hosts to change per host group, so each group is changed with one request
+        hostgroups_to_add = defaultdict(list)  # type: Dict[str, List[Dict[str, Any]]]
+        # Removals are keyed by (name, groupid), with the id taken from the host
+        # itself, since groups created after the host group fetch above are
+        # not in zabbix_hostgroups
+        hostgroups_to_remove = defaultdict(list)  # type: Dict[Tuple[str, str], List[Dict[str, Any]]]
+
+        # Loop invariants
+        base_hostgroup_names = frozenset([self.config.hostgroup_all])
+        no_importance_hostgroup_name = f"{self.config.hostgroup_importance_prefix}X"
+
         for zabbix_hostname, zabbix_host in zabbix_hosts.items():
             if self.stop_event.is_set():
                 logging.debug("Told to stop. Breaking")
                 break
 
-            if self.config.hostgroup_manual in [
-                group["name"] for group in zabbix_host["groups"]
-            ]:
+            host_hostgroup_ids = {
+                group["name"]: group["groupid"] for group in zabbix_host["groups"]
+            }
+            host_hostgroup_names = list(host_hostgroup_ids)
+            if self.config.hostgroup_manual in host_hostgroup_names:
                 logging.debug(
                     "Skipping manual host: '%s' (%s)",
                     zabbix_hostname,
@@ -1592,7 +1797,7 @@ class ZabbixHostgroupUpdater(ZabbixUpdater):
 
             db_host = db_hosts[zabbix_hostname]
 
-            synced_hostgroup_names = set([self.config.hostgroup_all])
+            synced_hostgroup_names = set(base_hostgroup_names)
             for _property in db_host.properties:
                 if _property in self.property_hostgroup_map:
                     synced_hostgroup_names.update(
@@ -1612,46 +1817,61 @@ class ZabbixHostgroupUpdater(ZabbixUpdater):
                     f"{self.config.hostgroup_importance_prefix}{db_host.importance}"
                 )
             else:
-                synced_hostgroup_names.add(
-                    f"{self.config.hostgroup_importance_prefix}X"
-                )
+                synced_hostgroup_names.add(no_importance_hostgroup_name)
 
-            host_hostgroups = {}
-            for zabbix_hostgroup in zabbix_host["groups"]:
-                host_hostgroups[zabbix_hostgroup["name"]] = zabbix_hostgroup["groupid"]
-
-            old_host_hostgroups = host_hostgroups.copy()
-
-            for hostgroup_name in list(host_hostgroups.keys()):
-                # TODO: Here lies a bug due to managed_hostgroup_names not being properly updated above?
-                if (
-                    hostgroup_name in managed_hostgroup_names
-                    and hostgroup_name not in synced_hostgroup_names
-                ):
-                    logging.debug(
-                        "Going to remove hostgroup '%s' from host '%s'.",
-                        hostgroup_name,
-                        zabbix_hostname,
-                    )
-                    del host_hostgroups[hostgroup_name]
-            for hostgroup_name in synced_hostgroup_names:
-                if hostgroup_name not in host_hostgroups.keys():
-                    logging.debug(
-                        "Going to add hostgroup '%s' to host '%s'.",
-                        hostgroup_name,
-                        zabbix_hostname,
-                    )
-                    zabbix_hostgroup_id = zabbix_hostgroups.get(hostgroup_name, None)
-                    if not zabbix_hostgroup_id:
-                        # The hostgroup doesn't exist. We need to create it.
-                        zabbix_hostgroup_id = self.create_hostgroup(hostgroup_name)
-                    host_hostgroups[hostgroup_name] = zabbix_hostgroup_id
+            # Managed groups the host should no longer be in, and groups it is missing
+            # TODO: Here lies a bug due to managed_hostgroup_names not being properly updated above?
+            hostgroup_names_to_remove = (
+                managed_hostgroup_names.intersection(host_hostgroup_names)
+                - synced_hostgroup_names
+            )
+            hostgroup_names_to_add = synced_hostgroup_names.difference(
+                host_hostgroup_names
+            )
 
-            if host_hostgroups != old_host_hostgroups:
+            for hostgroup_name in hostgroup_names_to_remove:
+                logging.debug(
+                    "Going to remove hostgroup '%s' from host '%s'.",
+                    hostgroup_name,
+                    zabbix_hostname,
+                )
+                hostgroups_to_remove[
+                    (hostgroup_name, host_hostgroup_ids[hostgroup_name])
+                ].append(zabbix_host)
+            for hostgroup_name in hostgroup_names_to_add:
+                logging.debug(
+                    "Going to add hostgroup '%s' to host '%s'.",
+                    hostgroup_name,
+                    zabbix_hostname,
+                )
+                if hostgroup_name not in zabbix_hostgroups:
+                    # The hostgroup doesn't exist. We need to create it.
+                    zabbix_hostgroup_id = self.create_hostgroup(hostgroup_name)
+                    if zabbix_hostgroup_id:
+                        # Don't create it again for the next host
+                        zabbix_hostgroups[hostgroup_name] = zabbix_hostgroup_id
+                hostgroups_to_add[hostgroup_name].append(zabbix_host)
+
+            if hostgroup_names_to_remove or hostgroup_names_to_add:
+                new_hostgroup_names = [
+                    name
+                    for name in host_hostgroup_names
+                    if name not in hostgroup_names_to_remove
+                ]
+                new_hostgroup_names.extend(hostgroup_names_to_add)
                 logging.info(
                     "Updating hostgroups on host '%s'. Old: %s. New: %s",
                     zabbix_hostname,
-                    ", ".join(old_host_hostgroups.keys()),
-                    ", ".join(host_hostgroups.keys()),
+                    ", ".join(host_hostgroup_names),
+                    ", ".join(new_hostgroup_names),
                 )
-                self.set_hostgroups(host_hostgroups, zabbix_host)
+
+        # Add before removing, so that no host is ever left without a host group
+        for hostgroup_name, hosts in hostgroups_to_add.items():
+            hostgroup_id = zabbix_hostgroups.get(hostgroup_name)
+            if not hostgroup_id:
+                # Not created (dry run or creation failed)
+                continue
+            self.add_hostgroup(hostgroup_name, hostgroup_id, hosts)
+        for (hostgroup_name, hostgroup_id), hosts in hostgroups_to_remove.items():
+            self.remove_hostgroup(hostgroup_name, hostgroup_id, hosts)
@@ -1,22 +1,26 @@
 from __future__ import annotations
 
-import copy
 import datetime
 import ipaddress
 import logging
 import multiprocessing
 import queue
 import re
+import socket
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
 from typing import Dict
 from typing import Iterable
 from typing import List
 from typing import MutableMapping
+from typing import Optional
 from typing import Set
 from typing import Tuple
 from typing import Union
 
 
+@lru_cache(maxsize=1024)
 def is_valid_regexp(pattern: str):
     try:
         re.compile(pattern)
@@ -25,7 +29,34 @@ def is_valid_regexp(pattern: str):
         return False
 
 
+@lru_cache(maxsize=1024)
+def compile_pattern(pattern: str) -> re.Pattern[str]:
+    """Compiles a regular expression, reusing the compiled pattern for
+    patterns that have been compiled before."""
+    return re.compile(pattern)
+
+
+def has_callable(obj: object, name: str) -> bool:
+    """Returns True if `obj` has a callable attribute `name`.
+
+    Used to recognize source collector and host modifier modules instead of
+    an isinstance check against the runtime_checkable protocols in `_types`,
+    which is slower and only checks that the attribute exists.
+    """
+    return callable(getattr(obj, name, None))
+
+
 def is_valid_ip(ip: str):
+    # inet_pton validates the address in C without building an address object.
+    # It does not accept IPv6 scope IDs ("fe80::1%eth0"), so leave those to ipaddress.
+    if "%" not in ip:
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, ip)
+                return True
+            except (OSError, ValueError):
+                pass
+        return False
     try:
         ipaddress.ip_address(ip)
         return True
@@ -33,66 +64,78 @@ def is_valid_ip(ip: str):
         return False
 
 
-def zabbix_tags2zac_tags(zabbix_tags: Iterable[Dict[str, str]]) -> Set[Tuple[str, ...]]:
-    return {tuple(tag.values()) for tag in zabbix_tags}
+_GET_TAG_VALUE = itemgetter("tag", "value")
+
+
+def zabbix_tags2zac_tags(zabbix_tags: Iterable[Dict[str, str]]) -> Set[Tuple[str, str]]:
+    # Fetch the tag and value by key, so the result does not depend on
+    # the order of the keys in the dicts. Any other keys are ignored.
+    return set(map(_GET_TAG_VALUE, zabbix_tags))
 
 
 def zac_tags2zabbix_tags(zac_tags: Iterable[Tuple[str, str]]) -> List[Dict[str, str]]:
-    zabbix_tags = [{"tag": tag[0], "value": tag[1]} for tag in zac_tags]
-    return zabbix_tags
+    # Index rather than unpack, so longer tuples are accepted (extra items are ignored)
+    return [{"tag": tag[0], "value": tag[1]} for tag in zac_tags]
 
 
-def read_map_file(path: Union[str, Path]) -> Dict[str, List[str]]:
-    _map = {}  # type: Dict[str, List[str]]
+# Splits comma-separated values and strips the whitespace around each value
+_VALUE_SPLIT = re.compile(r"\s*,\s*")
 
-    with open(path) as f:
-        for lineno, line in enumerate(f, start=1):
-            line = line.strip()
 
-            # empty line or comment
-            if not line or line.startswith("#"):
-                continue
+def read_map_file(path: Union[str, Path]) -> Dict[str, List[str]]:
+    # Read the whole file in one go instead of line by line
+    with open(path) as f:
+        lines = f.read().split("\n")
+    return _parse_map_lines(lines, path)
+
+
+def _parse_map_lines(
+    lines: Iterable[str], path: Union[str, Path]
+) -> Dict[str, List[str]]:
+    """Parses the lines of a map file. `path` is only used in log messages."""
+    # Values are stored as dict keys, an insertion-ordered set
+    _map = {}  # type: Dict[str, Dict[str, None]]
+    dup_value_keys = set()  # type: Set[str]
+    split_values = _VALUE_SPLIT.split  # bound once, called for every line
+
+    for lineno, line in enumerate(lines, start=1):
+        line = line.strip()
+
+        # empty line or comment (the most common cases, so check them first)
+        if not line or line[0] == "#":
+            continue
+
+        key, sep, value = line.partition(":")
+        key = key.strip()
+        # Only keep non-empty values
+        values = [v for v in split_values(value.strip()) if v] if sep else []
+        if not key or not values:
+            logging.warning(
+                "Invalid format at line %d in map file '%s'. Expected 'key:value', got '%s'.",
+                lineno,
+                path,
+                line,
+            )
+            continue
 
-            try:
-                key, value = line.split(":", 1)
-
-                # Remove whitespace and check for empty key
-                key = key.strip()
-                if not key:
-                    raise ValueError(f"Emtpy key on line {lineno} in map file {path}")
-
-                # Split on comma, but only keep non-empty values
-                values = list(filter(None, [s.strip() for s in value.split(",")]))
-                if not values or all(not s for s in values):
-                    raise ValueError(
-                        f"Empty value(s) on line {lineno} in map file {path}"
-                    )
-            except ValueError:
-                logging.warning(
-                    "Invalid format at line %d in map file '%s'. Expected 'key:value', got '%s'.",
-                    lineno,
-                    path,
-                    line,
-                )
-                continue
+        key_values = _map.get(key)
+        if key_values is None:
+            key_values = _map[key] = {}
+        else:
+            logging.warning(
+                "Duplicate key %s at line %d in map file '%s'.", key, lineno, path
+            )
 
-            if key in _map:
-                logging.warning(
-                    "Duplicate key %s at line %d in map file '%s'.", key, lineno, path
-                )
-                _map[key].extend(values)
-            else:
-                _map[key] = values
-
-    # Final pass to remove duplicate values
-    for key, values in _map.items():
-        values_dedup = list(dict.fromkeys(values))  # dict.fromkeys() guarantees order
-        if len(values) != len(values_dedup):
+        # Duplicate values are dropped as they are added, keeping the first occurrence
+        n_values = len(key_values)
+        key_values.update(dict.fromkeys(values))
+        if len(key_values) - n_values < len(values) and key not in dup_value_keys:
+            dup_value_keys.add(key)
             logging.warning(
                 "Ignoring duplicate values for key '%s' in map file '%s'.", key, path
             )
-        _map[key] = values_dedup
-    return _map
+
+    return {key: list(values) for key, values in _map.items()}
 
 
 def with_prefix(
@@ -144,8 +187,19 @@ def mapping_values_with_prefix(
     prefix: str,
     separator: str = "-",
 ) -> MutableMapping[str, List[str]]:
-    """Calls `with_prefix` on all items in the values (list) in the mapping `m`."""
-    m = copy.copy(m)  # don't modify the original mapping
+    """Calls `with_prefix` on all items in the values (list) in the mapping `m`.
+
+    Returns a new mapping, the original mapping is not modified."""
+    # Check the prefix and separator once instead of failing on every value
+    if not prefix or not separator:
+        logging.warning(
+            "Unable to replace prefix with '%s' using separator '%s'. Prefix and separator cannot be empty",
+            prefix,
+            separator,
+        )
+        return {key: [] for key in m}
+
+    result = {}  # type: Dict[str, List[str]]
     for key, value in m.items():
         new_values = []
         for v in value:
@@ -155,22 +209,32 @@ def mapping_values_with_prefix(
                 logging.warning("Unable to replace prefix in '%s' with '%s'", v, prefix)
                 continue
             new_values.append(new_value)
-        m[key] = new_values
-    return m
+        result[key] = new_values
+    return result
 
 
-def drain_queue(q: multiprocessing.Queue) -> None:
-    """Drains a multiprocessing.Queue by calling `queue.get_nowait()` until the queue is empty."""
-    while not q.empty():
+def drain_queue(q: multiprocessing.Queue, max_items: Optional[int] = None) -> int:
+    """Drains a multiprocessing.Queue by calling `queue.get_nowait()` until the queue is empty,
+    or until `max_items` items have been removed. Returns the number of items removed."""
+    n = 0
+    while max_items is None or n < max_items:
         try:
             q.get_nowait()
         except queue.Empty:
             break
+        n += 1
+    return n
 
 
 def timedelta_to_str(td: datetime.timedelta) -> str:
-    """Converts a timedelta to a string of the form HH:MM:SS."""
-    return str(td).partition(".")[0]
+    """Converts a timedelta to a string of the form HH:MM:SS.
+
+    Fractions of a second are dropped, and days are counted as hours."""
+    seconds = int(td.total_seconds())
+    sign = "-" if seconds < 0 else ""
+    hours, rest = divmod(abs(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{sign}{hours:02d}:{minutes:02d}:{seconds:02d}"
 
 
 def write_file(path: Union[str, Path], content: str, end: str = "\n") -> None: